@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from config import CHAT_RATE_PER_MINUTE, CHAT_BURST
+
+
+class TokenBucket:
+    """Allows `capacity` requests at once, refilled at `rate` requests per second."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Takes a token. Returns 0 on success, otherwise the seconds until one is available."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class AdmissionControl:
+    """
+    Decides which link requests get to do work.
+    - Per-chat token bucket: a chat can send CHAT_BURST links at once, then CHAT_RATE_PER_MINUTE per minute.
+    - Single-flight: concurrent requests for the same media (shortcode / story ID / normalized URL)
+      share one in-flight unit of work and all receive its result.
+    The global ceiling on running jobs is JobService's slots; requests that only wait for
+    another chat's flight are submitted without one (see in_flight).
+    """
+    def __init__(self, rate_per_minute=CHAT_RATE_PER_MINUTE, burst=CHAT_BURST):
+        self.rate = max(rate_per_minute, 0.001) / 60
+        self.burst = max(1, burst)
+        self.coalesced = 0
+        self._buckets = {} # chat_id -> TokenBucket
+        self._flights = {} # key -> asyncio.Task
+
+    # --- Rate limiting ---
+    def admit(self, chat_id):
+        """Returns 0 if the chat may start a request now, otherwise the seconds to wait."""
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Full buckets hold no state worth keeping
+            for key in [key for key, item in self._buckets.items() if item.full]:
+                del self._buckets[key]
+            bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    # --- Single-flight ---
+    def in_flight(self, key):
+        task = self._flights.get(key)
+        return task is not None and not task.done()
+
+    async def single_flight(self, key, work):
+        """
+        Runs work() once per key at a time. Returns (leader, result): leader is True for the
+        caller whose work() ran, the others get the same result.
+        If the leader is cancelled (its chat moved on), a waiting caller takes over.
+        """
+        while True:
+            task = self._flights.get(key) if key else None
+            if task is None or task.done():
+                task = asyncio.ensure_future(work())
+                if key:
+                    self._flights[key] = task
+                    task.add_done_callback(lambda t: self._land(key, t))
+                return True, await task
+
+            self.coalesced += 1
+            logging.info(f"Joining in-flight request for {key}")
+            try:
+                return False, await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Still running means this caller was cancelled, not the leader
+                if task.done() and task.cancelled():
+                    continue
+                raise
+
+    def _land(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
@@ -0,0 +1,372 @@
+"""
+Offline benchmark for the download-to-first-page pipeline.
+
+Generates synthetic clips (known sharp frames between blurred ones), then times:
+  - get_blur_score / SharpnessScorer per frame
+  - VideoService.analyze_video (every strategy)
+  - VideoService.save_frames (every extraction method) and the in-memory render_frames
+  - bot.py handlers end to end, against a fake Telegram bot and a fake InstagramService
+
+Results (frames/sec, p50/p95 latency, peak RSS) are written as JSON so runs can be
+compared across commits. Needs no network and no GPU.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --quick --output bench.json
+    python benchmark.py --resolutions 1280x720,1920x1080 --fps 30,60 --durations 10,30 --codecs mp4v,MJPG
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+CODEC_EXTENSIONS = {'mp4v': '.mp4', 'avc1': '.mp4', 'MJPG': '.avi', 'XVID': '.avi', 'VP80': '.webm'}
+SHARP_EVERY_SECONDS = 2 # One known sharp frame every N seconds, everything else is blurred
+
+
+# --- Helpers ---
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summarize(latencies, frames=None):
+    """p50/p95 in seconds and frames/sec at the median latency."""
+    p50 = percentile(latencies, 50)
+    summary = {'runs': len(latencies), 'p50_s': p50, 'p95_s': percentile(latencies, 95)}
+    if frames is not None and p50:
+        summary['frames_per_sec'] = frames / p50
+    return summary
+
+def peak_rss_mb():
+    """Peak RSS of this process and of (waited-for) worker processes, in MB (Linux reports KB)."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    return {'self': own, 'children': children}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+# --- Synthetic clips ---
+def make_clip(path, width, height, fps, seconds, codec):
+    """
+    Writes a moving textured scene. Every SHARP_EVERY_SECONDS there is one sharp frame,
+    all other frames are blurred. Returns the list of sharp frame indices, or None if the codec is unavailable.
+    """
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+    if not writer.isOpened():
+        return None
+
+    rng = np.random.default_rng(0)
+    texture = (rng.random((height, width * 2, 3)) * 255).astype(np.uint8)
+    texture = cv2.GaussianBlur(texture, (0, 0), 1.0)
+    cv2.rectangle(texture, (width // 2, height // 3), (width, 2 * height // 3), (255, 255, 255), 4)
+
+    total = int(fps * seconds)
+    sharp_every = max(1, int(fps * SHARP_EVERY_SECONDS))
+    sharp_frames = []
+    for i in range(total):
+        offset = (i * 4) % width
+        frame = np.ascontiguousarray(texture[:, offset:offset + width])
+        if i % sharp_every == sharp_every // 2:
+            sharp_frames.append(i)
+        else:
+            sigma = 2.0 + 2.0 * ((i % sharp_every) / sharp_every)
+            frame = cv2.GaussianBlur(frame, (0, 0), sigma)
+        writer.write(frame)
+    writer.release()
+    return sharp_frames
+
+def sharp_recall(candidates, sharp_frames, tolerance=2):
+    """Share of known sharp frames that show up in the top len(sharp_frames) candidates."""
+    if not sharp_frames:
+        return None
+    top = [idx for idx, _ in candidates[:len(sharp_frames)]]
+    found = sum(1 for s in sharp_frames if any(abs(s - idx) <= tolerance for idx in top))
+    return found / len(sharp_frames)
+
+
+# --- Component benchmarks ---
+def bench_scoring(clip_path, repeat):
+    from video_service import VideoService
+    from scoring_service import SharpnessScorer
+
+    cap = cv2.VideoCapture(clip_path)
+    frames = []
+    while len(frames) < 32:
+        success, frame = cap.read()
+        if not success:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        return {}
+
+    service = VideoService()
+    scorer = SharpnessScorer()
+    results = {}
+    for name, func in [
+        ('get_blur_score', lambda: [service.get_blur_score(f) for f in frames]),
+        ('scorer.score', lambda: [scorer.score(f) for f in frames]),
+    ]:
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - start)
+        results[name] = summarize(latencies, frames=len(frames))
+    return results
+
+def bench_analysis(clip_path, sharp_frames, repeat):
+    from video_service import VideoService
+
+    service = VideoService()
+    results = {}
+    for strategy in ('exhaustive', 'sampled'):
+        latencies = []
+        candidates = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            candidates = service.analyze_video(clip_path, strategy=strategy)
+            latencies.append(time.perf_counter() - start)
+        stats = getattr(service, 'last_stats', {})
+        summary = summarize(latencies, frames=stats.get('frames_total'))
+        summary['stats'] = stats
+        summary['sharp_recall'] = sharp_recall(candidates, sharp_frames)
+        results[strategy] = summary
+    return results, candidates
+
+def bench_save_frames(clip_path, candidates, repeat, work_dir):
+    from video_service import VideoService
+
+    service = VideoService()
+    page = candidates[:10]
+    results = {}
+    for method in ('sequential', 'seek'):
+        latencies = []
+        for i in range(repeat):
+            out_dir = os.path.join(work_dir, f"save_{method}_{i}")
+            start = time.perf_counter()
+            service.save_frames(clip_path, page, out_dir, method=method)
+            latencies.append(time.perf_counter() - start)
+            shutil.rmtree(out_dir, ignore_errors=True)
+        results[method] = summarize(latencies, frames=len(page))
+
+    # What the bot does: previews + full-quality documents encoded in memory, nothing written
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        service.render_frames(clip_path, page)
+        latencies.append(time.perf_counter() - start)
+    results['render_frames'] = summarize(latencies, frames=len(page))
+    return results
+
+
+# --- End to end through bot.py ---
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class FakeMessage:
+    def __init__(self, text=None, file_id=None, kind=None):
+        self.text = text
+        self.photo = [type('PhotoSize', (), {'file_id': file_id})()] if kind == 'photo' else []
+        self.document = type('Document', (), {'file_id': file_id})() if kind == 'document' else None
+
+class FakeUpdate:
+    def __init__(self, chat_id, text):
+        self.effective_chat = FakeChat(chat_id)
+        self.message = FakeMessage(text)
+        self.callback_query = None
+
+class FakeBot:
+    """Records what the handlers send; the first media group marks 'first page delivered'."""
+    def __init__(self):
+        self.first_page_at = None
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(text)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        if self.first_page_at is None:
+            self.first_page_at = time.perf_counter()
+        self.sent += 1
+        return [FakeMessage(file_id=f"photo-{chat_id}-{i}", kind='photo') for i in range(len(media))]
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.sent += 1
+        return FakeMessage(file_id=f"doc-{chat_id}", kind='document')
+
+class FakeContext:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.user_data = {}
+
+class FakeInstagramService:
+    """Serves the synthetic clip for any link, with an optional simulated network delay."""
+    def __init__(self, clip_path, delay=0.0):
+        self.clip_path = clip_path
+        self.delay = delay
+        self.logged_in = False
+
+    def login(self):
+        return True
+
+    def get_media_key(self, url, content_info=None, playlist_index=None):
+        return url.rstrip('/').rsplit('/', 1)[-1]
+
+    def normalize_url(self, url):
+        return url.strip().rstrip('/') + '/'
+
+    def check_download_type(self, url):
+        time.sleep(self.delay)
+        return {'type': 'video', 'info': {'id': self.get_media_key(url)}}
+
+    def get_stream_info(self, url, playlist_index=None):
+        return None
+
+    def get_full_quality_info(self, url, playlist_index=None):
+        return None
+
+    def download_post(self, url, target_dir, playlist_index=None):
+        time.sleep(self.delay)
+        os.makedirs(target_dir, exist_ok=True)
+        target = os.path.join(target_dir, os.path.basename(self.clip_path))
+        shutil.copyfile(self.clip_path, target)
+        return target
+
+def bench_bot(clip_path, repeat, delay):
+    import bot
+
+    bot.insta = FakeInstagramService(clip_path, delay)
+
+    async def run_once(chat_id, url):
+        context = FakeContext()
+        update = FakeUpdate(chat_id, url)
+        start = time.perf_counter()
+        await bot.handle_message(update, context)
+        task = bot.jobs.current(chat_id)
+        if task:
+            await task
+        done = time.perf_counter()
+        first = context.bot.first_page_at
+        return (first - start) if first else None, done - start
+
+    async def run_all():
+        results = {}
+        for label, same_link in (('cold', False), ('cache_hit', True)):
+            first_page, total = [], []
+            for i in range(repeat):
+                shortcode = "benchwarm" if same_link else f"bench{time.time_ns()}{i}"
+                if same_link and i == 0:
+                    await run_once(10_000, f"https://www.instagram.com/reel/{shortcode}/")
+                ttfp, elapsed = await run_once(1000 + i, f"https://www.instagram.com/reel/{shortcode}/")
+                if ttfp is not None:
+                    first_page.append(ttfp)
+                total.append(elapsed)
+            results[label] = {'time_to_first_page': summarize(first_page), 'total': summarize(total)}
+        bot.jobs.shutdown()
+        return results
+
+    return asyncio.run(run_all())
+
+
+# --- Main ---
+def parse_list(value, cast=str):
+    return [cast(v) for v in value.split(',') if v]
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the frame extraction pipeline.")
+    parser.add_argument('--resolutions', default="640x360,1280x720")
+    parser.add_argument('--fps', default="30")
+    parser.add_argument('--durations', default="5,15", help="Clip lengths in seconds")
+    parser.add_argument('--codecs', default="mp4v,MJPG")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--network-delay', type=float, default=0.0, help="Simulated seconds per fake Instagram call")
+    parser.add_argument('--skip-bot', action='store_true', help="Don't run the bot.py end-to-end benchmark")
+    parser.add_argument('--quick', action='store_true', help="One small clip, one repeat")
+    parser.add_argument('--output', default="benchmark.json")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.resolutions, args.fps, args.durations, args.codecs, args.repeat = "640x360", "30", "5", "mp4v", 1
+
+    output = os.path.abspath(args.output)
+    work_dir = tempfile.mkdtemp(prefix="insta_framer_bench_")
+
+    # bot.py writes temp files / logs / caches relative to the working directory
+    os.chdir(work_dir)
+    os.environ.setdefault("RESULT_CACHE_DIR", os.path.join(work_dir, "result_cache"))
+    os.environ.setdefault("PORT", "0")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'cpu_count': os.cpu_count(),
+        'clips': [],
+    }
+
+    try:
+        for resolution in parse_list(args.resolutions):
+            width, height = (int(v) for v in resolution.lower().split('x'))
+            for fps in parse_list(args.fps, int):
+                for seconds in parse_list(args.durations, float):
+                    for codec in parse_list(args.codecs):
+                        clip_path = os.path.join(work_dir, f"clip_{width}x{height}_{fps}_{seconds:g}s_{codec}{CODEC_EXTENSIONS.get(codec, '.avi')}")
+                        sharp_frames = make_clip(clip_path, width, height, fps, seconds, codec)
+                        if sharp_frames is None:
+                            print(f"Skipping codec {codec}: not available in this OpenCV build")
+                            continue
+
+                        print(f"Benchmarking {os.path.basename(clip_path)}...")
+                        analysis, candidates = bench_analysis(clip_path, sharp_frames, args.repeat)
+                        report['clips'].append({
+                            'width': width, 'height': height, 'fps': fps, 'seconds': seconds, 'codec': codec,
+                            'bytes': os.path.getsize(clip_path),
+                            'scoring': bench_scoring(clip_path, args.repeat),
+                            'analyze_video': analysis,
+                            'save_frames': bench_save_frames(clip_path, candidates, args.repeat, work_dir),
+                        })
+
+        if not args.skip_bot and report['clips']:
+            # End to end on the largest clip of the matrix
+            largest = max(report['clips'], key=lambda c: c['bytes'])
+            clip_path = os.path.join(work_dir, f"clip_{largest['width']}x{largest['height']}_{largest['fps']}_{largest['seconds']:g}s_{largest['codec']}{CODEC_EXTENSIONS.get(largest['codec'], '.avi')}")
+            print(f"Benchmarking bot handlers with {os.path.basename(clip_path)}...")
+            report['bot'] = {'clip': os.path.basename(clip_path), **bench_bot(clip_path, args.repeat, args.network_delay)}
+
+        report['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
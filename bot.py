@@ -1,18 +1,28 @@
+import time
+IMPORT_STARTED = time.perf_counter() # Before the other imports, for the startup report
+
+import asyncio
+import io
 import logging
+import math
 import os
-import shutil
-import uuid
-import time
+import secrets
+import signal
 import threading
 from telegram import Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-from config import BOT_TOKEN
-from instagram_service import InstagramService
-from video_service import VideoService
-from keep_alive import keep_alive
-
-# Start the web server for Render
-keep_alive()
+from config import (BOT_TOKEN, STREAM_MODE, PREFETCH_STORIES, PROGRESSIVE_MODE, DOCUMENT_FORMAT, PORT, WEBHOOK_URL,
+                    WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS, MAX_CONCURRENT_UPDATES, ANALYSIS_MAX_HEIGHT,
+                    STARTUP_MODE)
+from job_service import JobService, QueueFullError
+from cache_service import FileIdStore
+from prefetch_service import PrefetchService
+from segment_service import SegmentAnalyzer
+from metrics_service import metrics, record_analysis
+from web_service import WebServer
+from admission_service import AdmissionControl
+from startup_service import LazyService, ready, warm_up
+from url_service import get_media_key, normalize_url
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,56 +33,101 @@ logging.basicConfig(
     ]
 )
 
-# Initialize Services
-insta = InstagramService()
-video_processor = VideoService()
+# --- Services ---
+# Heavy ones (instaloader, OpenCV, disk scans, the sweep thread, the Instagram login) are built on
+# first use, or in the background once the bot accepts updates (see serve)
+def create_instagram(module):
+    service = module.InstagramService()
+    if not service.login():
+        print("Warning: Instagram login failed. Private posts will not be accessible.")
+    # Renews the session cookies in the background before they expire
+    service.session.start()
+    return service
+
+def create_storage(module):
+    # Request dirs are tracked in memory, kept under a byte quota and released as soon as a request is done;
+    # the sweep thread only removes abandoned ones
+    service = module.StorageManager()
+    service.start()
+    return service
+
+def restore_session(session):
+    # Restored from the session backend (after a restart, or saved by another process): a pending
+    # selection keeps the dir it works from, which the storage manager adopted unpinned
+    if session.get('awaiting_selection'):
+        storage.pin(session.get('temp_dir'))
+
+insta = LazyService('instagram', 'instagram_service', create_instagram)
+video_processor = LazyService('video', 'video_service', lambda module: module.VideoService())
+results = LazyService('result_cache', 'cache_service', lambda module: module.ResultCache())
+sessions = LazyService('sessions', 'session_service', lambda module: module.create_session_store(restore_session))
+storage = LazyService('storage', 'storage_service', create_storage)
+jobs = JobService()
+file_ids = FileIdStore(results)
+analyzer = SegmentAnalyzer(jobs, video_processor)
+admission = AdmissionControl()
+prefetch = PrefetchService(jobs, insta, analyzer, storage)
+
+async def services_ready():
+    """
+    Handlers use the services on the event loop: one that isn't built yet is built (or waited for,
+    if warm-up is building it) in a thread, so a slow build only delays this update, not the loop.
+    """
+    await ready((insta, video_processor, results, sessions, storage))
 
 PAGE_SIZE = 10
+DOCUMENT_EXTENSION = DOCUMENT_FORMAT if DOCUMENT_FORMAT in ("webp", "png") else "jpg"
+# ---------------------
 
-# --- Cleanup Logic ---
-def cleanup_loop():
-    """Periodically cleans up old temp files to save disk space on Render."""
-    TEMP_DIR = "temp_downloads"
-    MAX_AGE_SECONDS = 600 # 10 minutes
-    
-    while True:
-        try:
-            if os.path.exists(TEMP_DIR):
-                current_time = time.time()
-                for item in os.listdir(TEMP_DIR):
-                    item_path = os.path.join(TEMP_DIR, item)
-                    # Check if it's a directory (request ID)
-                    if os.path.isdir(item_path):
-                        # Get modification time
-                        mtime = os.path.getmtime(item_path)
-                        if current_time - mtime > MAX_AGE_SECONDS:
-                            try:
-                                shutil.rmtree(item_path)
-                                logging.info(f"Cleaned up old temp dir: {item}")
-                            except Exception as e:
-                                logging.error(f"Failed to delete {item}: {e}")
-            
-            time.sleep(300) # Check every 5 minutes
-        except Exception as e:
-            logging.error(f"Error in cleanup loop: {e}")
-            time.sleep(300)
-
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
-cleanup_thread.start()
+# --- Metrics ---
+# Values owned by the services are read when /metrics is scraped (services not built yet have none)
+def collect_metrics():
+    collected = [
+        ('jobs_active', jobs.active, {}),
+        ('jobs_waiting', jobs.waiting, {}),
+        ('coalesced_requests_total', admission.coalesced, {}),
+    ]
+    if storage.built:
+        collected.append(('temp_disk_bytes', storage.stats()['bytes'], {}))
+    if results.built:
+        result_stats = results.stats()
+        collected += [
+            ('result_cache_bytes', result_stats['bytes'], {}),
+            ('cache_requests_total', result_stats['hits'], {'cache': 'result', 'result': 'hit'}),
+            ('cache_requests_total', result_stats['misses'], {'cache': 'result', 'result': 'miss'}),
+        ]
+    return collected
+
+metrics.add_collector(collect_metrics)
 # ---------------------
 
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+metrics.set('startup_seconds', IMPORT_SECONDS, service='bot', stage='import')
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id, 
         text="👋 Hi! Send me an Instagram video link (Post or Reel). I'll extract the sharpest frames for you to choose from."
     )
 
+async def session_for(update: Update):
+    """
+    The chat's session (see SessionStore); persisted keys need sessions.save() after a change.
+    Answered from memory; only a miss reads the session backend, in a thread (not the IO pool,
+    where it would wait behind downloads).
+    """
+    chat_id = update.effective_chat.id
+    session = sessions.cached(chat_id)
+    if session is None:
+        session = await asyncio.get_running_loop().run_in_executor(None, sessions.get, chat_id)
+    return session
+
 async def send_frame_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     chat_id = update.effective_chat.id
-    candidates = context.user_data.get('all_candidates', [])
-    video_path = context.user_data.get('video_path')
-    temp_dir = context.user_data.get('temp_dir')
+    session = await session_for(update)
+    candidates = session.get('all_candidates', [])
+    video_path = session.get('video_path')
+    temp_dir = session.get('temp_dir')
     
     start_idx = page * PAGE_SIZE
     end_idx = start_idx + PAGE_SIZE
@@ -85,24 +140,69 @@ async def send_frame_page(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     if not page_candidates:
         await context.bot.send_message(chat_id=chat_id, text="⚠️ No more frames available.")
         return
+    if not storage.exists(temp_dir):
+        # Released (selection done) or evicted after the chat moved on
+        await context.bot.send_message(chat_id=chat_id, text="❌ Session expired. Please send the link again.")
+        return
+    # Still in use: the sweep measures a session's TTL from its last page / selection
+    storage.touch(temp_dir)
+
+    # Frames kept in memory during analysis (or from the result cache) are written out without decoding
+    frame_cache = session.get('frame_cache', {})
+    page_cache = {idx: frame_cache[idx] for idx, _ in page_candidates if idx in frame_cache}
+    keyframes = None
+    if len(page_cache) < len(page_candidates) and video_path:
+        # The rest from the video's frame index; what it doesn't hold is decoded from the nearest keyframe
+        from index_service import read_index
+        indexed, keyframes = await jobs.run_io(read_index, video_path, [idx for idx, _ in page_candidates
+                                                                        if idx not in page_cache])
+        page_cache.update(indexed)
+    
+    if len(page_cache) < len(page_candidates) and not video_path:
+        # Served from the result cache so far, but this page needs the video itself
+        video_path = await ensure_video(update, context)
+        if not video_path:
+            await context.bot.send_message(chat_id=chat_id, text="❌ Session expired. Please send the link again.")
+            return
 
-    # Save these specific frames
-    # video_service.save_frames sorts them by TIME for display context
-    frames = video_processor.save_frames(video_path, page_candidates, temp_dir)
+    # Encode these specific frames in memory
+    # video_service.render_frames sorts them by TIME for display context
+    with metrics.span('render_frames', kind='preview'):
+        if len(page_cache) == len(page_candidates):
+            # Nothing to decode
+            frames = video_processor.render_frames(video_path, page_candidates, page_cache)
+        else:
+            frames = await jobs.run_cpu(video_processor.render_frames, video_path, page_candidates, page_cache,
+                                        keyframes=keyframes)
+    # Everything up to here is fixed: a refined ranking only reorders what comes after
+    session['shown_count'] = max(session.get('shown_count', 0), end_idx)
+    frame_indices = [idx for idx, _, _ in frames]
     
     # Store currently displayed frames for selection mapping
     # We map "Selection 1" -> frames[0]
-    context.user_data['displayed_frames'] = frames 
+    session['displayed_frames'] = frames
+    sessions.save(session)
+    media_key = session.get('media_key')
+    new_frames = {idx: preview for idx, _, preview in frames if idx not in frame_cache}
+    if media_key and new_frames:
+        await jobs.run_io(results.add_frames, media_key, new_frames)
     
+    # Reuse already uploaded photos instead of sending the bytes again
+    upload_key = file_id_key(session)
     media_group = []
-    for i, (path, score) in enumerate(frames):
-        media_group.append(InputMediaPhoto(open(path, 'rb'), caption=f"{i+1}"))
+    for i, (idx, _, preview) in enumerate(frames):
+        media = file_ids.get(upload_key, idx, 'photo') or io.BytesIO(preview)
+        media_group.append(InputMediaPhoto(media, caption=f"{i+1}", filename=f"frame_{idx}.jpg"))
     
-    await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+    with metrics.span('telegram_send', kind='photo'):
+        messages = await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+    
+    uploaded = {idx: msg.photo[-1].file_id for idx, msg in zip(frame_indices, messages) if msg.photo}
+    await jobs.run_io(file_ids.update, upload_key, 'photo', uploaded)
     
     # Navigation Buttons
     keyboard = []
-    if end_idx < len(candidates):
+    if end_idx < len(candidates) or session.get('analysis'):
          keyboard.append([InlineKeyboardButton("🔄 Load More (Next 10)", callback_data=f"page_{page+1}")])
     
     reply_markup = InlineKeyboardMarkup(keyboard) if keyboard else None
@@ -114,54 +214,380 @@ async def send_frame_page(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
         parse_mode='Markdown'
     )
 
-async def process_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_path: str, temp_dir: str):
-    """Helper to process a downloaded video and present frames."""
+async def ensure_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Downloads the source video again for a session that was served from the result cache."""
+    session = await session_for(update)
+    url = session.get('source_url')
+    temp_dir = session.get('temp_dir')
+    if not url or not temp_dir:
+        return None
+    
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ Downloading...")
+    video_path = await jobs.run_io(insta.download_post, url, temp_dir, playlist_index=session.get('source_index'))
+    storage.refresh(temp_dir)
+    session['video_path'] = video_path
+    sessions.save(session)
+    return video_path
+
+def file_id_key(session):
+    """Key uploads are remembered under: the media key, or the request dir when the media has no stable ID."""
+    return session.get('media_key') or session.get('temp_dir')
+
+def start_session(session, candidates, frame_cache, video_path, temp_dir, media_key, source_url, source_index=None,
+                  shown_count=0):
+    """
+    Stores everything the paging/selection handlers need for this chat.
+    shown_count: candidates already sent for this video (a ranking that replaces a partial one).
+    """
+    stop_refinement(session)
+    previous = session.get('temp_dir')
+    if previous and previous != temp_dir:
+        # The chat moved on to another video, its old files are no longer needed
+        storage.release(previous)
+    storage.pin(temp_dir)
+    session['all_candidates'] = candidates
+    session['frame_cache'] = frame_cache
+    session['video_path'] = video_path
+    session['temp_dir'] = temp_dir
+    session['media_key'] = media_key
+    session['source_url'] = source_url
+    session['source_index'] = source_index
+    session['shown_count'] = shown_count
+    session['awaiting_selection'] = True
+    sessions.save(session)
+
+def start_refinement(session, state):
+    """Keeps a progressive analysis in the session and continues it in the background."""
+    session['analysis'] = state
+    task = asyncio.get_running_loop().create_task(refine_session(session, session.get('temp_dir')))
+    session['refine_task'] = task
+    return task
+
+def stop_refinement(session):
+    """Drops the background refinement of the current session, if any."""
+    task = session.pop('refine_task', None)
+    if task:
+        task.cancel()
+    session.pop('analysis', None)
+
+async def refine_session(session, temp_dir):
+    """
+    Scores the rest of a progressively analyzed video, one chunk per worker call.
+    The state is saved in the session after every chunk, so an interrupted refinement
+    resumes from there instead of starting over. Once done, the pages that weren't
+    shown yet are re-ranked from the full scores.
+    """
+    state = session.get('analysis')
+    result = None
+    try:
+        while state is not None and not state.done:
+            state, result = await jobs.run_cpu(video_processor.resume_analysis, state)
+            record_analysis(result['stats'])
+            if session.get('temp_dir') != temp_dir:
+                return # The session moved on
+            session['analysis'] = state
+    except Exception as e:
+        logging.error(f"Refinement of {temp_dir} failed: {e}")
+        return
+    if result is None:
+        return
+    
+    # Frames already shown stay in place, later pages come from the refined ranking
+    shown = session.get('all_candidates', [])[:session.get('shown_count', 0)]
+    all_candidates = video_processor.select_candidates(result['candidates'], result['min_distance'], seed=shown,
+                                                       signatures=state.signatures, scene_cuts=result['scene_cuts'])
+    frame_cache = {**session.get('frame_cache', {}), **result['frames']}
+    session['all_candidates'] = all_candidates
+    session['frame_cache'] = frame_cache
+    session.pop('analysis', None)
+    sessions.save(session)
+    logging.info(f"Refined ranking of {temp_dir}: {result['stats']}")
+    
+    media_key = session.get('media_key')
+    if media_key:
+        await jobs.run_io(results.put, media_key, all_candidates, frame_cache)
+
+async def finish_refinement(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Waits for the background refinement (resuming it if it was interrupted) so the next page uses the refined ranking."""
+    session = await session_for(update)
+    state = session.get('analysis')
+    if not state:
+        return
+    task = session.get('refine_task')
+    if task is None or task.done():
+        task = start_refinement(session, state)
+    await context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ Still analyzing the rest of the video...")
+    # A cancelled page request must not cancel the refinement itself
+    await asyncio.shield(task)
+
+async def serve_cached(update: Update, context: ContextTypes.DEFAULT_TYPE, media_key, source_url, source_index=None):
+    """Presents a previously analyzed video from the result cache. Returns False on a miss."""
+    if not media_key:
+        return False
+    cached = await jobs.run_io(results.get, media_key)
+    if not cached:
+        return False
+    
+    logging.info(f"Result cache hit for {media_key}")
+    for kind, ids in cached['file_ids'].items():
+        file_ids.update(media_key, kind, ids, persist=False)
+    
+    await present_result(update, context, cached['candidates'], cached['frames'], media_key, source_url, source_index)
+    return True
+
+async def present_result(update: Update, context: ContextTypes.DEFAULT_TYPE, candidates, frames, media_key,
+                         source_url, source_index=None):
+    """Starts a session from an analysis done elsewhere (result cache, another chat's request) and sends page 0."""
+    temp_dir = storage.create()
+    start_session(await session_for(update), candidates, frames, None, temp_dir, media_key, source_url, source_index)
+    await send_frame_page(update, context, page=0)
+
+def shared_result(session, temp_dir):
+    """What a finished fetch_video hands to the chats that joined it, or None if nothing was shown."""
+    if session.get('temp_dir') != temp_dir or not session.get('awaiting_selection'):
+        return None
+    # Pages already rendered for this chat don't need the video again
+    frames = dict(session['frame_cache'])
+    frames.update((idx, preview) for idx, _, preview in session.get('displayed_frames', []) if preview)
+    return {'candidates': list(session['all_candidates']), 'frames': frames, 'media_key': session.get('media_key')}
+
+def start_indexing(session, video_path, candidates, frame_cache):
+    """Writes the video's frame index in the background, once page 0 is out (pages decode without it meanwhile)."""
+    session['index_task'] = asyncio.get_running_loop().create_task(write_index(video_path, candidates, frame_cache))
+
+async def write_index(video_path, candidates, frame_cache):
+    """Writes the frame index next to an analyzed video, so its pages don't need the video anymore."""
+    try:
+        with metrics.span('build_index'):
+            await jobs.run_cpu(video_processor.build_index, video_path, candidates, frame_cache)
+    except Exception as e:
+        # Pages are decoded from the video instead
+        logging.error(f"Could not write the frame index of {video_path}: {e}")
+    storage.refresh(os.path.dirname(video_path))
+
+async def process_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_path: str, temp_dir: str,
+                        media_key=None, source_url=None, source_index=None, result=None):
+    """Helper to process a downloaded video and present frames. result: analysis that was already done (prefetch)."""
     chat_id = update.effective_chat.id
     
     try:
-        await context.bot.send_message(chat_id=chat_id, text="🎞 Extracting and analyzing frames...")
-        
         # 1. Analyze to get ALL candidates
-        all_candidates = video_processor.analyze_video(video_path)
+        state = None
+        if result is None:
+            await context.bot.send_message(chat_id=chat_id, text="🎞 Extracting and analyzing frames...")
+            if PROGRESSIVE_MODE:
+                # Quick sampled pass for the first page, the other frames are scored in the background
+                state, result = await jobs.run_cpu(video_processor.start_analysis, video_path)
+                record_analysis(result['stats'])
+                if state and not result['candidates']:
+                    # Nothing usable among the samples: score everything before giving up
+                    state, result = await jobs.run_cpu(video_processor.resume_analysis, state, 0)
+                    record_analysis(result['stats'])
+            else:
+                result = await analyzer.analyze(video_path)
+        all_candidates = result['candidates']
+        refining = state is not None and not state.done
         
         if not all_candidates:
             await context.bot.send_message(chat_id=chat_id, text="❌ No sharp frames found.")
-            shutil.rmtree(temp_dir)
+            storage.release(temp_dir)
             return
             
+        # Remember the result for the next request of the same media (progressive: once refined)
+        if media_key and not refining:
+            await jobs.run_io(results.put, media_key, all_candidates, result['frames'])
+        
         # Store in context
-        context.user_data['all_candidates'] = all_candidates
-        context.user_data['video_path'] = video_path
-        context.user_data['temp_dir'] = temp_dir
-        context.user_data['awaiting_selection'] = True
+        start_session(await session_for(update), all_candidates, result['frames'], video_path, temp_dir,
+                      media_key, source_url, source_index)
         
         # Send first page
         await send_frame_page(update, context, page=0)
+        start_indexing(await session_for(update), video_path, all_candidates, result['frames'])
+        if refining:
+            start_refinement(await session_for(update), state)
         
+    except asyncio.CancelledError:
+        # User sent a new link while we were still working on this one
+        storage.release(temp_dir)
+        raise
     except Exception as e:
         logging.error(f"Error processing video: {e}")
         await context.bot.send_message(chat_id=chat_id, text="❌ An error occurred during processing.")
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        storage.release(temp_dir)
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
+async def stream_video(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, temp_dir: str,
+                       media_key=None, source_index=None):
+    """
+    Scores the video while it is still downloading and shows the first page as soon as
+    the first seconds are analyzed. Returns False if nothing could be streamed (caller downloads instead).
+    """
     chat_id = update.effective_chat.id
     
-    # Check if we are waiting for a selection
-    if 'awaiting_selection' in context.user_data and context.user_data['awaiting_selection']:
-        await handle_selection(update, context)
+    media_info = await jobs.run_io(insta.get_stream_info, url, source_index)
+    if not media_info:
+        metrics.inc('fallbacks_total', kind='stream')
+        return False
+    media_key = media_key or media_info.get('id')
+    
+    loop = asyncio.get_running_loop()
+    first_page = loop.create_future()
+    cancel_event = threading.Event()
+    
+    def on_partial(result):
+        # Called from the worker thread
+        loop.call_soon_threadsafe(lambda: first_page.done() or first_page.set_result(result))
+    
+    await context.bot.send_message(chat_id=chat_id, text="🎞 Downloading and analyzing frames...")
+    video_path = os.path.join(temp_dir, "video.mkv")
+    analysis = asyncio.ensure_future(jobs.run_io(
+        video_processor.analyze_stream, media_info, video_path, on_partial=on_partial, cancel_event=cancel_event))
+    
+    shown = []
+    try:
+        await asyncio.wait({first_page, analysis}, return_when=asyncio.FIRST_COMPLETED)
+        
+        if first_page.done() and first_page.result()['candidates']:
+            # 1. First page from frames kept in memory, while the rest is still downloading
+            partial = first_page.result()
+            start_session(await session_for(update), partial['candidates'], partial['frames'], None, temp_dir,
+                          media_key, url, source_index)
+            await send_frame_page(update, context, page=0)
+            shown = partial['candidates'][:PAGE_SIZE]
+        
+        result = await analysis
+    except asyncio.CancelledError:
+        cancel_event.set()
+        storage.release(temp_dir)
+        raise
+    except Exception as e:
+        # Handled like a failed stream: fall back to the download (unless a page is already out)
+        logging.error(f"Stream analysis of {url} failed: {e}")
+        cancel_event.set()
+        await asyncio.gather(analysis, return_exceptions=True)
+        result = None
+    
+    if not result:
+        metrics.inc('fallbacks_total', kind='stream')
+        # Don't let a partial copy be mistaken for the downloaded video
+        if os.path.exists(video_path):
+            os.remove(video_path)
+        # Keep whatever was already shown, later pages re-download on demand
+        return bool(shown)
+    record_analysis(result['stats'])
+    if os.path.exists(video_path):
+        metrics.inc('downloaded_bytes_total', os.path.getsize(video_path), source='stream')
+    if not result['candidates']:
+        await context.bot.send_message(chat_id=chat_id, text="❌ No sharp frames found.")
+        storage.release(temp_dir)
+        return True
+    
+    try:
+        # 2. Final ranking; frames already shown stay first so the next page continues from there
+        signatures = {**partial['signatures'], **result['signatures']} if shown else result['signatures']
+        all_candidates = video_processor.select_candidates(result['candidates'], result['min_distance'], seed=shown,
+                                                           signatures=signatures, scene_cuts=result['scene_cuts'])
+        session = await session_for(update)
+        frame_cache = {**session.get('frame_cache', {}), **result['frames']} if shown else result['frames']
+        if media_key:
+            await jobs.run_io(results.put, media_key, all_candidates, frame_cache)
+        
+        # Page 0 may already be out: the next page continues after it
+        start_session(session, all_candidates, frame_cache, video_path, temp_dir, media_key, url, source_index,
+                      shown_count=session.get('shown_count', 0) if shown else 0)
+        if not shown:
+            await send_frame_page(update, context, page=0)
+        start_indexing(session, video_path, all_candidates, frame_cache)
+    except Exception as e:
+        logging.error(f"Error processing streamed video: {e}")
+        if not shown:
+            await context.bot.send_message(chat_id=chat_id, text="❌ An error occurred during processing.")
+            storage.release(temp_dir)
+    return True
+
+async def notify_queued(chat_id: int, context: ContextTypes.DEFAULT_TYPE, position: int):
+    await context.bot.send_message(chat_id=chat_id, text=f"⏳ I'm busy right now, you are #{position} in line. Please wait...")
+
+async def admit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Per-chat rate limit for requests that start a download. Returns False (and tells the user) if over it."""
+    wait = admission.admit(update.effective_chat.id)
+    if wait:
+        metrics.inc('rate_limited_total')
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text=f"🚦 Slow down a little: you can send another link in {math.ceil(wait)} seconds.")
+        return False
+    return True
+
+def flight_keys(url, media_key=None, index=None):
+    """Single-flight keys of a link: its metadata check and its video (shortcode / story ID, else the URL)."""
+    normalized = normalize_url(url)
+    return f"check:{normalized}", f"video:{media_key or normalized}#{index or ''}"
+
+async def submit_job(update: Update, context: ContextTypes.DEFAULT_TYPE, coro, flights=()):
+    """
+    Runs a download/analysis pipeline as a background job for this chat.
+    flights: its single-flight keys; if one is already in flight the job will mostly wait for
+    another chat's result, so it doesn't take a job slot.
+    """
+    chat_id = update.effective_chat.id
+    needs_slot = not any(admission.in_flight(key) for key in flights)
+    try:
+        jobs.submit(chat_id, coro, on_queued=lambda position: notify_queued(chat_id, context, position),
+                    needs_slot=needs_slot)
+    except QueueFullError:
+        await context.bot.send_message(chat_id=chat_id, text="🚦 Too many requests right now. Please try again in a minute.")
+
+async def fetch_video(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, media_key=None, index=None):
+    """Downloads (or streams) and analyzes a video, then presents it. Returns shared_result()."""
+    chat_id = update.effective_chat.id
+    temp_dir = storage.create()
+    
+    if STREAM_MODE and await stream_video(update, context, url, temp_dir, media_key, index):
+        return shared_result(await session_for(update), temp_dir)
+    
+    if not index:
+        await context.bot.send_message(chat_id=chat_id, text="⏳ Downloading...")
+    try:
+        video_path = await jobs.run_io(insta.download_post, url, temp_dir, playlist_index=index)
+    except asyncio.CancelledError:
+        storage.release(temp_dir)
+        raise
+    
+    if not video_path:
+        await context.bot.send_message(chat_id=chat_id, text=f"❌ Failed to download Story {index}." if index
+                                       else "❌ Failed to download video.")
+        storage.release(temp_dir)
+        return None
+    storage.refresh(temp_dir)
+    
+    await process_video(update, context, video_path, temp_dir, media_key, url, index)
+    return shared_result(await session_for(update), temp_dir)
+
+async def fetch_shared(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, media_key=None, index=None):
+    """fetch_video, coalesced: chats asking for the same video at the same time get the first request's result."""
+    _, video_key = flight_keys(url, media_key, index)
+    leader, shared = await admission.single_flight(video_key, lambda: fetch_video(update, context, url, media_key, index))
+    if leader:
         return
+    if not shared:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text="❌ Couldn't get frames from this video.")
+        return
+    await present_result(update, context, shared['candidates'], shared['frames'], shared['media_key'] or media_key,
+                         url, index)
 
-    # Assume it's a URL
-    if "instagram.com" not in text:
-        await context.bot.send_message(chat_id=chat_id, text="Please send a valid Instagram link or the frame numbers you want (e.g., '1, 3').")
+async def handle_link(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
+    chat_id = update.effective_chat.id
+
+    # Posts/Reels can be looked up before touching the network
+    media_key = get_media_key(url)
+    if await serve_cached(update, context, media_key, url):
         return
 
     await context.bot.send_message(chat_id=chat_id, text="⏳ Checking content...")
     
-    # Check content type (Playlist vs Single)
-    content_info = insta.check_download_type(text)
+    # Check content type (Playlist vs Single), once for all chats sending this link right now
+    check_key, _ = flight_keys(url)
+    _, content_info = await admission.single_flight(check_key, lambda: jobs.run_io(insta.check_download_type, url))
     
     if content_info['type'] == 'playlist':
         count = content_info['count']
@@ -179,69 +605,138 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append(row)
             
         reply_markup = InlineKeyboardMarkup(keyboard)
-        context.user_data['pending_playlist_url'] = text
+        session = await session_for(update)
+        session['pending_playlist_url'] = url
+        # Only the entry IDs are needed to key the stories later
+        session['pending_playlist_info'] = {'type': 'playlist', 'count': count, 'info': {
+            'entries': [{'id': (entry or {}).get('id')} for entry in content_info['info'].get('entries') or []]}}
+        sessions.save(session)
         await context.bot.send_message(chat_id=chat_id, text=msg, reply_markup=reply_markup)
         
+        if PREFETCH_STORIES:
+            prefetch.start(chat_id, url, count)
+        
     elif content_info['type'] == 'video':
         # Single video, proceed directly
-        request_id = str(uuid.uuid4())
-        temp_dir = os.path.join("temp_downloads", request_id)
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        await context.bot.send_message(chat_id=chat_id, text="⏳ Downloading...")
-        video_path = insta.download_post(text, temp_dir)
+        if not media_key:
+            media_key = get_media_key(url, content_info)
+            if await serve_cached(update, context, media_key, url):
+                return
         
-        if not video_path:
-             await context.bot.send_message(chat_id=chat_id, text="❌ Failed to download video.")
-             shutil.rmtree(temp_dir)
-             return
-             
-        await process_video(update, context, video_path, temp_dir)
+        await fetch_shared(update, context, url, media_key)
         
     else:
         # Error or unknown
         await context.bot.send_message(chat_id=chat_id, text=f"❌ Could not process link: {content_info.get('error', 'Unknown error')}")
 
+async def handle_story(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, index: int):
+    chat_id = update.effective_chat.id
+
+    media_key = get_media_key(url, (await session_for(update)).get('pending_playlist_info'), playlist_index=index)
+    if await serve_cached(update, context, media_key, url, index):
+        return
+    
+    # Already downloaded (and usually analyzed) in the background
+    item = await prefetch.take(chat_id, url, index)
+    if item:
+        await process_video(update, context, item['video_path'], item['temp_dir'], media_key, url, index, item['result'])
+        return
+
+    await fetch_shared(update, context, url, media_key, index)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await services_ready()
+    text = update.message.text.strip()
+    chat_id = update.effective_chat.id
+    is_link = "instagram.com" in text
+    session = await session_for(update)
+    
+    # Check if we are waiting for a selection (a new link always starts over)
+    if not is_link and session.get('awaiting_selection'):
+        await handle_selection(update, context)
+        return
+
+    # Assume it's a URL
+    if not is_link:
+        await context.bot.send_message(chat_id=chat_id, text="Please send a valid Instagram link or the frame numbers you want (e.g., '1, 3').")
+        return
+
+    if not await admit(update, context):
+        return
+
+    session['awaiting_selection'] = False
+    sessions.save(session)
+    # Moving on: stories prefetched / frames still being scored for the previous link are no longer needed
+    prefetch.cancel(chat_id)
+    stop_refinement(session)
+    # The old session's files may be evicted from now on
+    storage.unpin(session.get('temp_dir'))
+    await submit_job(update, context, handle_link(update, context, text), flight_keys(text, get_media_key(text)))
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer() 
+    await services_ready()
     data = query.data
-    chat_id = update.effective_chat.id
     
     if data.startswith("story_"):
         index = int(data.split("_")[1])
-        url = context.user_data.get('pending_playlist_url')
+        session = await session_for(update)
+        url = session.get('pending_playlist_url')
         
         if not url:
             await query.edit_message_text("❌ Session expired. Please send the link again.")
             return
             
+        if not await admit(update, context):
+            return
         await query.edit_message_text(f"⏳ Downloading Story {index}...")
-        
-        request_id = str(uuid.uuid4())
-        temp_dir = os.path.join("temp_downloads", request_id)
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        video_path = insta.download_post(url, temp_dir, playlist_index=index)
-        
-        if not video_path:
-             await context.bot.send_message(chat_id=chat_id, text=f"❌ Failed to download Story {index}.")
-             shutil.rmtree(temp_dir)
-             return
-             
-        await process_video(update, context, video_path, temp_dir)
+        media_key = get_media_key(url, session.get('pending_playlist_info'), playlist_index=index)
+        await submit_job(update, context, handle_story(update, context, url, index), flight_keys(url, media_key, index))
 
     elif data.startswith("page_"):
         page = int(data.split("_")[1])
+        await finish_refinement(update, context)
         await send_frame_page(update, context, page=page)
 
+async def render_full_quality(session, frame_indices):
+    """
+    Full-quality documents of the selected frames. Returns {frame_idx: bytes}.
+    When the analysis download was capped (ANALYSIS_MAX_HEIGHT), the frames are seeked from the
+    highest resolution rendition instead, without downloading it. Otherwise, or if that fails,
+    they are decoded from the local video.
+    """
+    video_path = session.get('video_path')
+    if not (video_path and os.path.exists(video_path)):
+        video_path = None
+    local = await jobs.run_io(video_processor.video_info, video_path) if video_path else None
+    from index_service import read_index
+    _, keyframes = await jobs.run_io(read_index, video_path, ())
+    
+    url = session.get('source_url')
+    if ANALYSIS_MAX_HEIGHT and url:
+        remote = await jobs.run_io(insta.get_full_quality_info, url, session.get('source_index'))
+        fps = (local or {}).get('fps') or (remote or {}).get('fps')
+        if remote and fps and (not local or remote['height'] > local['height']):
+            with metrics.span('render_frames', kind='remote_document'):
+                documents = await jobs.run_io(video_processor.render_documents_remote, remote, frame_indices, fps)
+            if documents:
+                return documents
+            logging.info(f"Full-quality frames of {url} unavailable, using the analysis download")
+    
+    if not video_path:
+        return {}
+    with metrics.span('render_frames', kind='document'):
+        return await jobs.run_cpu(video_processor.render_documents, video_path, frame_indices, keyframes=keyframes)
+
 async def handle_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     chat_id = update.effective_chat.id
+    session = await session_for(update)
     
     try:
         selection_indices = [int(x.strip()) - 1 for x in text.split(',') if x.strip().isdigit()]
-        displayed_frames = context.user_data.get('displayed_frames', [])
+        displayed_frames = session.get('displayed_frames', [])
         
         if not selection_indices:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ Please enter valid numbers (e.g., '1, 3').")
@@ -250,47 +745,114 @@ async def handle_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
         selected_files = []
         for idx in selection_indices:
             if 0 <= idx < len(displayed_frames):
-                selected_files.append(displayed_frames[idx][0]) # path
+                selected_files.append(displayed_frames[idx]) # (frame_idx, score, preview bytes)
         
         if not selected_files:
             await context.bot.send_message(chat_id=chat_id, text="⚠️ No valid frames selected from the current list.")
             return
             
         await context.bot.send_message(chat_id=chat_id, text="📤 Sending full quality files...")
+        storage.touch(session.get('temp_dir'))
+        
+        upload_key = file_id_key(session)
         
-        for file_path in selected_files:
-            await context.bot.send_document(chat_id=chat_id, document=open(file_path, 'rb'))
+        # Full-quality frames that were never uploaded are rendered now, from the best copy
+        missing = [frame_idx for frame_idx, _, _ in selected_files if not file_ids.get(upload_key, frame_idx, 'document')]
+        documents = await render_full_quality(session, missing) if missing else {}
+        
+        uploaded = {}
+        with metrics.span('telegram_send', kind='document'):
+            for frame_idx, _, preview in selected_files:
+                # Same frame already sent as a document (by anyone): reference it instead of uploading again
+                file_id = file_ids.get(upload_key, frame_idx, 'document')
+                if file_id:
+                    await context.bot.send_document(chat_id=chat_id, document=file_id)
+                    continue
+                document = documents.get(frame_idx)
+                if document is None and preview is None:
+                    # Session restored after a restart, with neither the video nor the preview
+                    continue
+                if document is None:
+                    # No video to decode from: the preview is the best copy we have
+                    await context.bot.send_document(chat_id=chat_id, document=io.BytesIO(preview), filename=f"frame_{frame_idx}.jpg")
+                    continue
+                message = await context.bot.send_document(chat_id=chat_id, document=io.BytesIO(document),
+                                                          filename=f"frame_{frame_idx}.{DOCUMENT_EXTENSION}")
+                if message.document:
+                    uploaded[frame_idx] = message.document.file_id
+        await jobs.run_io(file_ids.update, upload_key, 'document', uploaded)
             
-        # Cleanup
-        # We rely on the periodic cleanup loop to handle this now for robustness
-        # But we can still cleanup here immediately to be nice
-        temp_dir = context.user_data.get('temp_dir')
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-            except Exception as e:
-                logging.error(f"Cleanup error: {e}")
+        stop_refinement(session)
+        
+        # Cleanup: the request is complete, free its space right away
+        storage.release(session.get('temp_dir'))
             
         # Reset state
-        context.user_data['awaiting_selection'] = False
-        context.user_data['frames'] = []
-        context.user_data['all_candidates'] = []
+        prefetch.cancel(chat_id)
+        session['awaiting_selection'] = False
+        session['all_candidates'] = []
+        session['displayed_frames'] = []
+        session['frame_cache'] = {}
+        sessions.save(session)
         await context.bot.send_message(chat_id=chat_id, text="✅ Done! Send another link to start again.")
 
     except Exception as e:
         logging.error(f"Error handling selection: {e}")
         await context.bot.send_message(chat_id=chat_id, text="❌ Error sending files.")
 
+async def serve(application):
+    """
+    Runs the bot until SIGINT / SIGTERM, with health / metrics (and the webhook) on one HTTP server.
+    Webhook mode when WEBHOOK_URL is set, long polling otherwise (local development).
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    services = [insta, video_processor, results, sessions, storage]
+    if STARTUP_MODE == "eager":
+        await warm_up(services, jobs)
+
+    # The webhook is registered again on every start, so a generated secret only has to live as long as the process
+    secret = (WEBHOOK_SECRET or secrets.token_urlsafe(32)) if WEBHOOK_URL else None
+    server = WebServer(application, WEBHOOK_PATH if WEBHOOK_URL else None, secret)
+    async with application:
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=secret,
+                                              max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        else:
+            # A webhook left over from a deployment would make getUpdates fail
+            await application.bot.delete_webhook()
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        await server.start(PORT)
+        ready = time.perf_counter() - IMPORT_STARTED
+        metrics.set('startup_seconds', ready, service='bot', stage='ready')
+        logging.info(f"Ready in {ready:.2f}s (bot.py imported in {IMPORT_SECONDS:.2f}s, startup mode: {STARTUP_MODE})")
+        print(f"Bot is running ({'webhook' if WEBHOOK_URL else 'polling'})...")
+        warming = asyncio.ensure_future(warm_up(services, jobs)) if STARTUP_MODE != "eager" else None
+
+        try:
+            await stop.wait()
+        finally:
+            if warming:
+                warming.cancel()
+            await server.stop()
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+
 if __name__ == '__main__':
     if not BOT_TOKEN:
         print("Error: BOT_TOKEN not found in environment variables.")
         exit(1)
     
-    # Attempt login on startup
-    if not insta.login():
-         print("Warning: Instagram login failed. Private posts will not be accessible.")
-
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Handlers only await I/O or worker pools, so updates from different users can run side by side
+    builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(MAX_CONCURRENT_UPDATES)
+    if WEBHOOK_URL:
+        builder = builder.updater(None) # Updates arrive through WebServer
+    application = builder.build()
     
     start_handler = CommandHandler('start', start)
     message_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message)
@@ -300,6 +862,5 @@ if __name__ == '__main__':
     application.add_handler(message_handler) 
     application.add_handler(callback_handler)
     
-    print("Bot is polling...")
-    application.run_polling()
+    asyncio.run(serve(application))
 
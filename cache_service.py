@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from config import RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, FILE_ID_CACHE_SIZE
+
+
+class ResultCache:
+    """
+    On-disk cache of analysis results, keyed by Instagram shortcode / story media ID.
+    Each entry is a directory:
+        meta.json        -> ranked candidates, creation time, Telegram file_ids
+        frame_<idx>.jpg  -> pre-rendered frames for the first pages
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    once the cache grows past `max_bytes`.
+    """
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index = {} # key -> {'size': bytes, 'accessed': ts}
+        self._load_index()
+
+    # --- Index ---
+    def _load_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            meta_path = os.path.join(entry_dir, "meta.json")
+            if not os.path.exists(meta_path):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            self._index[key] = {'size': self._dir_size(entry_dir), 'accessed': os.path.getmtime(meta_path)}
+        logging.info(f"Result cache: {len(self._index)} entries, {self.total_bytes()} bytes")
+
+    def _dir_size(self, path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def _entry_dir(self, key):
+        # Keys come from URLs / yt-dlp ids, keep them filesystem safe
+        return os.path.join(self.cache_dir, re.sub(r'[^A-Za-z0-9_-]', '_', str(key)))
+
+    def total_bytes(self):
+        return sum(item['size'] for item in self._index.values())
+
+    def stats(self):
+        return {
+            'entries': len(self._index),
+            'bytes': self.total_bytes(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    # --- Read / Write ---
+    def _read_meta(self, key):
+        with open(os.path.join(self._entry_dir(key), "meta.json")) as f:
+            return json.load(f)
+
+    def _write_meta(self, key, meta):
+        path = os.path.join(self._entry_dir(key), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, key):
+        """
+        Returns {'candidates': [(frame_idx, score)], 'frames': {frame_idx: jpeg bytes}, 'file_ids': {...}}
+        or None on a miss / expired entry.
+        """
+        if not key:
+            return None
+        name = os.path.basename(self._entry_dir(key))
+
+        with self._lock:
+            try:
+                if name not in self._index:
+                    raise FileNotFoundError(name)
+                meta = self._read_meta(key)
+                if time.time() - meta['created'] > self.ttl:
+                    self._remove(name)
+                    raise FileNotFoundError(name)
+
+                entry_dir = self._entry_dir(key)
+                frames = {}
+                for frame_idx in meta['frames']:
+                    with open(os.path.join(entry_dir, f"frame_{frame_idx}.jpg"), 'rb') as f:
+                        frames[frame_idx] = f.read()
+
+                # Mark as recently used
+                os.utime(os.path.join(entry_dir, "meta.json"))
+                self._index[name]['accessed'] = time.time()
+            except (OSError, ValueError, KeyError):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return {
+                'candidates': [tuple(c) for c in meta['candidates']],
+                'frames': frames,
+                'file_ids': {kind: {int(idx): file_id for idx, file_id in ids.items()}
+                             for kind, ids in meta.get('file_ids', {}).items()},
+            }
+
+    def put(self, key, candidates, frames):
+        """
+        Stores ranked candidates and {frame_idx: jpeg bytes} for a media key.
+        Storing a key again (e.g. the refined ranking of the same video) replaces the ranking but keeps
+        the entry's frames and Telegram file_ids, which still point at the same frames.
+        """
+        if not key:
+            return
+        name = os.path.basename(self._entry_dir(key))
+
+        with self._lock:
+            previous = None
+            if name in self._index:
+                try:
+                    previous = self._read_meta(key)
+                    if time.time() - previous['created'] > self.ttl:
+                        previous = None
+                except (OSError, ValueError, KeyError):
+                    previous = None
+            if previous is None:
+                self._remove(name)
+            entry_dir = self._entry_dir(key)
+            try:
+                os.makedirs(entry_dir, exist_ok=True)
+                for frame_idx, data in frames.items():
+                    with open(os.path.join(entry_dir, f"frame_{frame_idx}.jpg"), 'wb') as f:
+                        f.write(data)
+                meta = {
+                    'created': time.time(),
+                    'candidates': [list(c) for c in candidates],
+                    'frames': sorted(set(frames) | set(previous['frames'] if previous else ())),
+                    'file_ids': previous.get('file_ids', {}) if previous else {},
+                }
+                self._write_meta(key, meta)
+            except OSError as e:
+                logging.error(f"Failed to cache result for {key}: {e}")
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return
+
+            self._index[name] = {'size': self._dir_size(entry_dir), 'accessed': time.time()}
+            self._evict()
+
+    def add_frames(self, key, frames):
+        """Stores more rendered frames ({frame_idx: jpeg bytes}) in an existing entry."""
+        name = os.path.basename(self._entry_dir(key or ""))
+        with self._lock:
+            if not key or name not in self._index:
+                return
+            entry_dir = self._entry_dir(key)
+            try:
+                meta = self._read_meta(key)
+                for frame_idx, data in frames.items():
+                    with open(os.path.join(entry_dir, f"frame_{frame_idx}.jpg"), 'wb') as f:
+                        f.write(data)
+                meta['frames'] = sorted(set(meta['frames']) | set(frames))
+                self._write_meta(key, meta)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Failed to extend cached result for {key}: {e}")
+                return
+            self._index[name]['size'] = self._dir_size(entry_dir)
+            self._evict()
+
+    def set_file_ids(self, key, kind, file_ids):
+        """Records Telegram file_ids ({frame_idx: file_id}) of a given kind ('photo', 'document')."""
+        name = os.path.basename(self._entry_dir(key or ""))
+        with self._lock:
+            if not key or name not in self._index:
+                return
+            try:
+                meta = self._read_meta(key)
+                stored = meta.setdefault('file_ids', {}).setdefault(kind, {})
+                stored.update({str(frame_idx): file_id for frame_idx, file_id in file_ids.items()})
+                self._write_meta(key, meta)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"Failed to store file_ids for {key}: {e}")
+
+    # --- Eviction ---
+    def _remove(self, name):
+        if name in self._index:
+            del self._index[name]
+        shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+    def _evict(self):
+        """Drops least recently used entries until the cache fits in max_bytes."""
+        total = self.total_bytes()
+        for name in sorted(self._index, key=lambda n: self._index[n]['accessed']):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[name]['size']
+            self._remove(name)
+            self.evictions += 1
+            logging.info(f"Evicted cached result {name}")
+
+
+class FileIdStore:
+    """
+    Telegram file_ids of frames that were already uploaded, keyed by (media key, frame index, kind).
+    Kept in a bounded in-memory LRU and persisted next to the cached result, so any later send of
+    the same frame (same user, another user, a re-requested page) references the file_id instead
+    of uploading the bytes again.
+    """
+    def __init__(self, result_cache=None, max_entries=FILE_ID_CACHE_SIZE):
+        self.result_cache = result_cache
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._ids = OrderedDict() # (media_key, frame_idx, kind) -> file_id
+
+    def get(self, media_key, frame_idx, kind):
+        with self._lock:
+            file_id = self._ids.get((media_key, frame_idx, kind))
+            if file_id:
+                self._ids.move_to_end((media_key, frame_idx, kind))
+            return file_id
+
+    def update(self, media_key, kind, file_ids, persist=True):
+        """Records {frame_idx: file_id}. persist=False only fills the in-memory map (e.g. after a cache hit)."""
+        if not media_key or not file_ids:
+            return
+        with self._lock:
+            for frame_idx, file_id in file_ids.items():
+                self._ids[(media_key, frame_idx, kind)] = file_id
+                self._ids.move_to_end((media_key, frame_idx, kind))
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+        if persist and self.result_cache:
+            self.result_cache.set_file_ids(media_key, kind, file_ids)
+
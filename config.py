@@ -14,3 +14,88 @@ INSTAGRAM_PASSWORD = os.environ.get("INSTAGRAM_PASSWORD")
 BLUR_THRESHOLD = 100.0 # Threshold for Laplacian variance (higher is sharper)
 # Removed FRAME_INTERVAL to process every frame as requested
 
+
+# Server Settings
+PORT = int(os.environ.get("PORT", 8080)) # Health check, /metrics and (webhook mode) Telegram updates
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") # Public base URL (e.g. https://my-bot.onrender.com); unset = long polling
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") # Telegram sends it back in every update request; others get a 403 (unset: a random one per start)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40)) # Parallel connections Telegram opens to the webhook
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 64)) # Updates handled at the same time (both modes)
+
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy") # "lazy" (services built in the background once updates are accepted) or "eager" (built before)
+
+# Job Execution Settings
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 4)) # Threads for yt-dlp / instaloader network calls
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", os.cpu_count() or 1)) # Processes for frame decoding/scoring
+MAX_ACTIVE_JOBS = int(os.environ.get("MAX_ACTIVE_JOBS", 4)) # Links processed at the same time
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 20)) # Links allowed to wait for a free slot
+CHAT_RATE_PER_MINUTE = float(os.environ.get("CHAT_RATE_PER_MINUTE", 6)) # Links a chat can send per minute (sustained)
+CHAT_BURST = int(os.environ.get("CHAT_BURST", 3)) # Links a chat can send back to back
+
+# Analysis Settings
+ANALYSIS_STRATEGY = os.environ.get("ANALYSIS_STRATEGY", "exhaustive") # "exhaustive" (score every frame) or "sampled" (coarse-to-fine)
+SAMPLE_STEP = int(os.environ.get("SAMPLE_STEP", 6)) # Sampled mode: score every Nth frame in the coarse pass
+REFINE_PEAKS = int(os.environ.get("REFINE_PEAKS", 30)) # Sampled mode: number of coarse peaks re-scored densely
+MAX_CANDIDATES = int(os.environ.get("MAX_CANDIDATES", 200)) # Ranked candidates kept per video (0 = unlimited)
+SCORING_HEIGHT = int(os.environ.get("SCORING_HEIGHT", 360)) # Frames are downscaled to this height before scoring (0 = full resolution)
+FRAME_CACHE_SIZE = int(os.environ.get("FRAME_CACHE_SIZE", 30)) # Best frames kept as in-memory JPEGs during analysis (0 = off)
+FRAME_EXTRACTION = os.environ.get("FRAME_EXTRACTION", "sequential") # "sequential" (single decode pass) or "seek" (per-frame seek)
+MIN_DISTANCE_SECONDS = float(os.environ.get("MIN_DISTANCE_SECONDS", 0.5)) # Minimum time between two candidates of the same scene
+DUPLICATE_DISTANCE = int(os.environ.get("DUPLICATE_DISTANCE", 5)) # Frames whose 64-bit signatures differ in fewer bits are near-duplicates (max 7)
+SCENE_CUT_DISTANCE = int(os.environ.get("SCENE_CUT_DISTANCE", 20)) # Consecutive frames differing in more bits start a new scene
+PROGRESSIVE_MODE = os.environ.get("PROGRESSIVE_MODE", "0") == "1" # Send page 0 after a sampled pass, refine the ranking in the background
+REFINE_CHUNK_FRAMES = int(os.environ.get("REFINE_CHUNK_FRAMES", 300)) # Progressive mode: frames scored per background refinement step
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", os.cpu_count() or 1)) # Segments one video is split into and scored in parallel (1 = off)
+SEGMENT_MIN_SECONDS = float(os.environ.get("SEGMENT_MIN_SECONDS", 5.0)) # Shorter segments aren't worth a worker process
+
+# Download Format Settings
+ANALYSIS_MAX_HEIGHT = int(os.environ.get("ANALYSIS_MAX_HEIGHT", 720)) # Largest video height downloaded for analysis (0 = no cap); selected frames come from the best rendition
+PREFERRED_VCODEC = os.environ.get("PREFERRED_VCODEC", "h264") # Codec preferred for analysis downloads (OpenCV decodes H.264 fastest)
+
+# Result Cache Settings
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 24 * 3600)) # Seconds
+FILE_ID_CACHE_SIZE = int(os.environ.get("FILE_ID_CACHE_SIZE", 10000)) # Telegram file_ids kept in memory
+
+# Frame Output Settings
+PREVIEW_JPEG_QUALITY = int(os.environ.get("PREVIEW_JPEG_QUALITY", 85)) # Page previews (Telegram recompresses photos anyway)
+DOCUMENT_JPEG_QUALITY = int(os.environ.get("DOCUMENT_JPEG_QUALITY", 95)) # Full-quality files sent on selection (also WebP quality)
+DOCUMENT_FORMAT = os.environ.get("DOCUMENT_FORMAT", "jpg") # Full-quality format: "jpg", "webp" or "png" (lossless, slowest)
+INDEX_THUMBNAILS = int(os.environ.get("INDEX_THUMBNAILS", 30)) # Top-ranked previews stored in the per-video frame index (0 = no index)
+
+# Temp Storage Settings
+TEMP_DIR = os.environ.get("TEMP_DIR", "temp_downloads")
+TEMP_MAX_BYTES = int(os.environ.get("TEMP_MAX_BYTES", 1024 * 1024 * 1024)) # Request dirs beyond this are evicted (LRU, unpinned only)
+TEMP_IDLE_TTL = int(os.environ.get("TEMP_IDLE_TTL", 600)) # Seconds an unused request dir is kept
+TEMP_PINNED_TTL = int(os.environ.get("TEMP_PINNED_TTL", 3600)) # Seconds a session waiting for a selection keeps its dir after its last page / selection
+TEMP_SWEEP_INTERVAL = int(os.environ.get("TEMP_SWEEP_INTERVAL", 60)) # Seconds between sweeps for abandoned dirs
+
+# Session Settings
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory") # "memory" or "sqlite" (survives restarts, shared by processes on one host)
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.sqlite3")
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 1000)) # Chat sessions kept in memory (LRU)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 3600)) # Seconds an idle session is kept
+
+# Streaming Settings
+STREAM_MODE = os.environ.get("STREAM_MODE", "0") == "1" # Score frames while the video is still downloading (needs ffmpeg)
+STREAM_FIRST_PAGE_SECONDS = float(os.environ.get("STREAM_FIRST_PAGE_SECONDS", 3.0)) # Video seconds to score before the first page
+FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
+
+# Instagram Settings
+META_CACHE_TTL = int(os.environ.get("META_CACHE_TTL", 300)) # Seconds yt-dlp metadata is reused between check and download
+RESOLVER_MAX_CONNECTIONS = int(os.environ.get("RESOLVER_MAX_CONNECTIONS", 10)) # Pooled connections of the story resolver
+RESOLVER_TIMEOUT = float(os.environ.get("RESOLVER_TIMEOUT", 20)) # Seconds per resolver request
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get("DOWNLOAD_CHUNK_BYTES", 256 * 1024)) # Streamed downloads are written in chunks of this size
+COOKIE_REFRESH_MARGIN = int(os.environ.get("COOKIE_REFRESH_MARGIN", 3 * 24 * 3600)) # Seconds before the session cookie expires when it's renewed
+COOKIE_VALIDATE_INTERVAL = int(os.environ.get("COOKIE_VALIDATE_INTERVAL", 6 * 3600)) # Seconds a successful session probe is trusted
+COOKIE_CHECK_INTERVAL = int(os.environ.get("COOKIE_CHECK_INTERVAL", 900)) # Seconds between background checks of the session expiry
+COOKIE_LOGIN_BACKOFF = int(os.environ.get("COOKIE_LOGIN_BACKOFF", 1800)) # Minimum seconds between Instagram logins (doubled after each failed one)
+
+# Story Prefetch Settings
+PREFETCH_STORIES = os.environ.get("PREFETCH_STORIES", "0") == "1" # Download & analyze all stories as soon as a playlist is detected
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", 3)) # Stories downloaded at the same time (all chats)
+PREFETCH_MAX_ITEMS = int(os.environ.get("PREFETCH_MAX_ITEMS", 10)) # Stories prefetched per playlist
+PREFETCH_USER_BYTES = int(os.environ.get("PREFETCH_USER_BYTES", 100 * 1024 * 1024)) # Prefetched bytes per chat
+PREFETCH_GLOBAL_BYTES = int(os.environ.get("PREFETCH_GLOBAL_BYTES", 500 * 1024 * 1024)) # Prefetched bytes in total
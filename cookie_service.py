@@ -0,0 +1,224 @@
+import io
+import logging
+import threading
+import time
+import instaloader
+from requests.cookies import RequestsCookieJar
+from yt_dlp.cookies import YoutubeDLCookieJar
+from config import (INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, COOKIE_REFRESH_MARGIN, COOKIE_VALIDATE_INTERVAL,
+                    COOKIE_CHECK_INTERVAL, COOKIE_LOGIN_BACKOFF)
+
+COOKIE_DOMAIN = ".instagram.com"
+AUTH_COOKIE = "sessionid"
+# Same query instaloader's test_login() runs: the logged-in user, or null
+PROBE_QUERY = "d6f4427fbe92d846298cf93df0b937d3"
+
+
+class SharedCookieJar(YoutubeDLCookieJar, RequestsCookieJar):
+    """
+    One jar with both APIs: instaloader's requests session uses it as a RequestsCookieJar,
+    every YoutubeDL as its cookiejar, and the story resolver's httpx client wraps it.
+    """
+    pass
+
+
+class CookieSession:
+    """
+    Lifecycle of the logged-in Instagram session.
+    - Cookies are loaded once into a SharedCookieJar (COOKIES_B64, the instaloader session file or a
+      password login) and only ever live in memory; all clients read and update that same jar.
+    - Validation is lazy: the first request that relies on the session runs one cheap probe, and a
+      good result is trusted for `validate_interval` seconds (a failed probe is retried after `check_interval`).
+    - Only the background thread logs in again (session file, then password): `refresh_margin` seconds
+      before the session cookie expires, or as soon as a probe found the session invalid. Requests
+      never log in themselves, and attempts are at least `login_backoff` seconds apart, doubling
+      after each failed one, so a session that can't be renewed doesn't turn into a login per request.
+    """
+    MAX_LOGIN_BACKOFF = 24 * 3600
+
+    def __init__(self, loader, username=INSTAGRAM_USERNAME, password=INSTAGRAM_PASSWORD,
+                 refresh_margin=COOKIE_REFRESH_MARGIN, validate_interval=COOKIE_VALIDATE_INTERVAL,
+                 check_interval=COOKIE_CHECK_INTERVAL, login_backoff=COOKIE_LOGIN_BACKOFF):
+        self.loader = loader
+        self.username = username
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.validate_interval = validate_interval
+        self.check_interval = check_interval
+        self.login_backoff = login_backoff
+        self.jar = SharedCookieJar()
+        self.valid = None # Result of the last probe (None: not probed since the cookies changed, or it failed)
+        self.probed = 0.0 # Time of the last probe attempt
+        self.last_login_attempt = 0.0
+        self.login_failures = 0 # Consecutive renewals that didn't produce a valid session
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._attach()
+
+    # --- Cookies ---
+    def _attach(self):
+        """Points instaloader's session at the shared jar (a login replaces its session)."""
+        session = self.loader.context._session
+        session.cookies = self.jar
+        csrf_token = self.jar.get('csrftoken', domain=COOKIE_DOMAIN)
+        if csrf_token:
+            session.headers['X-CSRFToken'] = csrf_token
+
+    def _adopt(self, cookies):
+        """Replaces the jar's contents, in place, so every client sees the new session at once."""
+        cookies = list(cookies)
+        with self._lock:
+            self.jar.clear()
+            for cookie in cookies:
+                # Cookies restored from an instaloader session file have no domain
+                self.jar.set(cookie.name, cookie.value, domain=cookie.domain or COOKIE_DOMAIN,
+                             path=cookie.path or '/', expires=cookie.expires, secure=True)
+            self._attach()
+            self.valid = None
+            self.probed = 0.0
+
+    def load_netscape(self, text):
+        """Loads cookies from a Netscape cookies.txt (e.g. decoded COOKIES_B64). Returns False if unusable."""
+        jar = YoutubeDLCookieJar()
+        try:
+            jar.load(io.StringIO(text))
+        except Exception as e:
+            logging.error(f"Failed to read cookies: {e}")
+            return False
+        self._adopt(jar)
+        return self.has_session
+
+    def export_netscape(self):
+        """The session as Netscape cookies.txt text (what COOKIES_B64 expects)."""
+        out = io.StringIO()
+        with self._lock:
+            self.jar.save(out)
+        return out.getvalue()
+
+    @property
+    def has_session(self):
+        return any(cookie.name == AUTH_COOKIE and cookie.value for cookie in self.jar)
+
+    @property
+    def expires(self):
+        """Expiry timestamp of the session cookie, or None if unknown."""
+        return next((cookie.expires for cookie in self.jar if cookie.name == AUTH_COOKIE and cookie.expires), None)
+
+    # --- Login ---
+    def login(self):
+        """Makes sure there is a session: the loaded cookies, else the session file, else a password login."""
+        if self.has_session:
+            return True
+        return self._login()
+
+    def _login(self):
+        if not self.username:
+            logging.warning("Instagram username not set.")
+            return False
+        with self._lock:
+            self.last_login_attempt = time.time()
+            try:
+                self.loader.load_session_from_file(self.username)
+                self._adopt(self.loader.context._session.cookies)
+                logging.info(f"Loaded session for {self.username}")
+                return True
+            except FileNotFoundError:
+                logging.info("No session file found, falling back to password login...")
+            except Exception as e:
+                logging.warning(f"Session load error: {e}. Falling back to password login...")
+
+            if not self.password:
+                logging.warning("Instagram password not set.")
+                return False
+            try:
+                self.loader.login(self.username, self.password)
+            except Exception as e:
+                logging.error(f"Login failed: {e}")
+                return False
+            self._adopt(self.loader.context._session.cookies)
+            logging.info(f"Logged in as {self.username}")
+            return True
+
+    # --- Validation ---
+    def ensure_valid(self):
+        """
+        Probes the session if it hasn't been recently. Returns whether the session is usable; an invalid
+        one is handed to the background thread for renewal (the request goes on without logging in).
+        Cheap when nothing is due: no I/O at all.
+        """
+        if not self.has_session:
+            return False
+        if self._probe_due():
+            with self._lock:
+                if self._probe_due():
+                    self._probe()
+        if self.valid is False:
+            self._wake.set()
+            return False
+        return True
+
+    def _probe_due(self):
+        # An invalid session isn't probed again: renewing it is the background thread's job
+        if self.valid is False:
+            return False
+        return time.time() - self.probed >= (self.validate_interval if self.valid else self.check_interval)
+
+    def _probe(self):
+        self.probed = time.time()
+        try:
+            data = self.loader.context.graphql_query(PROBE_QUERY, {})
+        except instaloader.LoginRequiredException:
+            user = None
+        except instaloader.InstaloaderException as e:
+            # Network trouble says nothing about the cookies: try again on the next request
+            logging.warning(f"Session probe failed: {e}")
+            return
+        else:
+            user = (data.get('data') or {}).get('user')
+        self.valid = bool(user)
+        if user:
+            # instaloader only treats its context as logged in with a username
+            self.loader.context.username = user.get('username') or self.username
+        logging.info(f"Instagram session is {'valid' if user else 'no longer valid'}")
+
+    # --- Background refresh ---
+    def needs_refresh(self):
+        expires = self.expires
+        return self.valid is False or bool(expires and expires - time.time() < self.refresh_margin)
+
+    def next_login_at(self):
+        """Earliest time the next login may be attempted."""
+        backoff = min(self.login_backoff * 2 ** self.login_failures, self.MAX_LOGIN_BACKOFF)
+        return self.last_login_attempt + backoff
+
+    def renew(self):
+        """Logs in again if the session needs it and the backoff allows it. Returns whether it tried."""
+        if not (self.has_session and self.needs_refresh()) or time.time() < self.next_login_at():
+            return False
+        logging.info("Renewing the Instagram session...")
+        if self._login():
+            self._probe()
+        if self.valid:
+            self.login_failures = 0
+        else:
+            self.login_failures += 1
+            logging.warning(f"Instagram session renewal failed ({self.login_failures} in a row), "
+                            f"next attempt in {self.next_login_at() - time.time():.0f}s")
+        return True
+
+    def start(self):
+        """Checks the session every check_interval seconds (or when a request found it invalid) in a daemon thread."""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, daemon=True, name="cookie-refresh")
+        self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            try:
+                self.renew()
+            except Exception as e:
+                logging.error(f"Error renewing the Instagram session: {e}")
@@ -1,14 +1,20 @@
 import base64
 import os
+import instaloader
+from cookie_service import CookieSession
 
 def export_cookies():
     cookie_file = "cookies.txt"
-    if not os.path.exists(cookie_file):
-        print(f"Error: {cookie_file} not found. Please run the bot locally once to generate it (or ensure you are logged in).")
-        return
-
-    with open(cookie_file, 'rb') as f:
-        cookie_data = f.read()
+    if os.path.exists(cookie_file):
+        with open(cookie_file, 'rb') as f:
+            cookie_data = f.read()
+    else:
+        # The bot keeps its cookies in memory only: build the file from the instaloader session instead
+        session = CookieSession(instaloader.Instaloader())
+        if not session.login():
+            print(f"Error: {cookie_file} not found and no Instagram session to export. Run setup_session.py first.")
+            return
+        cookie_data = session.export_netscape().encode()
     
     b64_cookies = base64.b64encode(cookie_data).decode('utf-8')
     
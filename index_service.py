@@ -0,0 +1,130 @@
+import logging
+import mmap
+import os
+import struct
+import numpy as np
+
+
+class FrameIndex:
+    """
+    Compact per-video index written next to the analyzed video (<video>.fidx), so pages,
+    previews and re-requests are served from it without opening the video again.
+    Layout (little endian, all sections contiguous):
+        header      magic, version, fps, candidate / keyframe / thumbnail counts
+        candidates  (frame int32, time float32, score float32, keyframe int32), ranked
+        keyframes   frame indices (int32), ascending
+        thumbnails  (frame int32, offset uint64, length uint32), by frame, then the encoded previews
+    The file is memory-mapped: lookups slice the mapping, nothing is parsed or decoded up front.
+    """
+    MAGIC = b'FIDX'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIdIII')
+    CANDIDATE = np.dtype([('frame', '<i4'), ('time', '<f4'), ('score', '<f4'), ('keyframe', '<i4')])
+    KEYFRAME = np.dtype('<i4')
+    THUMBNAIL = np.dtype([('frame', '<i4'), ('offset', '<u8'), ('length', '<u4')])
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.fps, self._candidates, self._keyframes, self._thumbnails = \
+                self.HEADER.unpack_from(self._map, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"not a frame index: {path}")
+        except (struct.error, ValueError):
+            self._map.close()
+            raise
+        self._keyframe_offset = self.HEADER.size + self._candidates * self.CANDIDATE.itemsize
+        self._thumbnail_offset = self._keyframe_offset + self._keyframes * self.KEYFRAME.itemsize
+
+    @staticmethod
+    def path_for(video_path):
+        return video_path + ".fidx"
+
+    @classmethod
+    def load(cls, video_path):
+        """Index of a video, or None if it has none (not analyzed here, or a re-download)."""
+        path = cls.path_for(video_path)
+        if not os.path.exists(path):
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning(f"Ignoring unreadable frame index {path}: {e}")
+            return None
+
+    @classmethod
+    def write(cls, video_path, fps, candidates, keyframes, thumbnails):
+        """
+        candidates: ranked [(frame_idx, score)]
+        keyframes: ascending frame indices ([] if unknown)
+        thumbnails: {frame_idx: encoded preview}
+        Returns the index path.
+        """
+        keyframes = np.asarray(sorted(keyframes), dtype=cls.KEYFRAME)
+        rows = np.zeros(len(candidates), dtype=cls.CANDIDATE)
+        if candidates:
+            rows['frame'], rows['score'] = zip(*candidates)
+        if fps:
+            rows['time'] = rows['frame'] / fps
+        if len(keyframes):
+            # Nearest keyframe at or before each frame: decoding it starts there
+            rows['keyframe'] = keyframes[np.maximum(np.searchsorted(keyframes, rows['frame'], 'right') - 1, 0)]
+
+        frames = sorted(thumbnails)
+        table = np.zeros(len(frames), dtype=cls.THUMBNAIL)
+        table['frame'] = frames
+        table['length'] = [len(thumbnails[frame_idx]) for frame_idx in frames]
+        start = cls.HEADER.size + rows.nbytes + keyframes.nbytes + table.nbytes
+        table['offset'] = start + np.concatenate(([0], np.cumsum(table['length'], dtype=np.uint64)[:-1]))
+
+        path = cls.path_for(video_path)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, fps or 0.0, len(rows), len(keyframes), len(table)))
+            f.write(rows.tobytes())
+            f.write(keyframes.tobytes())
+            f.write(table.tobytes())
+            for frame_idx in frames:
+                f.write(thumbnails[frame_idx])
+        os.replace(path + ".tmp", path)
+        return path
+
+    def candidates(self):
+        """Ranked [(frame_idx, score)]."""
+        rows = np.frombuffer(self._map, self.CANDIDATE, self._candidates, self.HEADER.size)
+        return list(zip(rows['frame'].tolist(), rows['score'].tolist()))
+
+    def keyframes(self):
+        return np.frombuffer(self._map, self.KEYFRAME, self._keyframes, self._keyframe_offset).tolist()
+
+    def thumbnails(self, frame_indices):
+        """{frame_idx: encoded preview} for the requested frames that have one."""
+        table = np.frombuffer(self._map, self.THUMBNAIL, self._thumbnails, self._thumbnail_offset)
+        found = {}
+        for frame_idx in frame_indices:
+            pos = int(np.searchsorted(table['frame'], frame_idx))
+            if pos < len(table) and table['frame'][pos] == frame_idx:
+                start, length = int(table['offset'][pos]), int(table['length'][pos])
+                found[frame_idx] = self._map[start:start + length]
+        return found
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_index(video_path, frame_indices):
+    """
+    (thumbnails, keyframes) of a video from its index: {frame_idx: preview} for the requested
+    frames that have one, and its keyframe indices. ({}, None) if the video has no index.
+    """
+    index = FrameIndex.load(video_path) if video_path else None
+    if index is None:
+        return {}, None
+    with index:
+        return index.thumbnails(frame_indices), index.keyframes()
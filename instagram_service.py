@@ -1,9 +1,15 @@
 import instaloader
 import os
-import re
+import copy
+import time
 import logging
-from urllib.parse import urlparse
-from config import INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD
+import threading
+from contextlib import contextmanager
+from config import META_CACHE_TTL, ANALYSIS_MAX_HEIGHT, PREFERRED_VCODEC
+from metrics_service import metrics
+from resolver_service import MediaResolver, USER_AGENT
+from cookie_service import CookieSession
+import url_service
 
 import base64
 
@@ -18,150 +24,252 @@ class InstagramService:
             save_metadata=False,
             compress_json=False
         )
-        self.logged_in = False
+        # One in-memory cookie jar for instaloader, yt-dlp and the resolver
+        self.session = CookieSession(self.loader)
+        
+        # yt-dlp metadata cache (normalized URL -> (timestamp, info)) and per-thread YoutubeDL instances
+        self._meta_cache = {}
+        self._meta_lock = threading.Lock()
+        self._local = threading.local()
+        
+        # Async story lookups / downloads for when yt-dlp fails
+        self.resolver = MediaResolver(self.session.jar)
         
         # --- Restore Cookies from Env (for Render) ---
         cookies_b64 = os.environ.get('COOKIES_B64')
         if cookies_b64:
             try:
-                logging.info("Found COOKIES_B64 env var. Restoring cookies.txt...")
-                cookie_data = base64.b64decode(cookies_b64)
-                with open("cookies.txt", "wb") as f:
-                    f.write(cookie_data)
-                logging.info("cookies.txt restored successfully.")
-                self.logged_in = True # Assume these cookies are valid to start with
+                logging.info("Found COOKIES_B64 env var. Loading cookies...")
+                if self.session.load_netscape(base64.b64decode(cookies_b64).decode()):
+                    logging.info("Cookies loaded, the session is checked on first use.")
+                else:
+                    logging.error("COOKIES_B64 holds no Instagram session.")
             except Exception as e:
                 logging.error(f"Failed to decode COOKIES_B64: {e}")
         # ---------------------------------------------
 
+    @property
+    def logged_in(self):
+        return self.session.has_session
+
     def login(self):
-        if self.logged_in:
-            return True
-            
-        if not INSTAGRAM_USERNAME:
-            print("Instagram username not set.")
-            return False
-            
-        # Try to load session file first (most robust)
-        try:
-            print(f"Attempting to load session for {INSTAGRAM_USERNAME}...")
-            self.loader.load_session_from_file(INSTAGRAM_USERNAME)
-            self.logged_in = True
-            print(f"Loaded session for {INSTAGRAM_USERNAME}")
-            return True
-        except FileNotFoundError:
-            print("No session file found. Falling back to password login...")
-        except Exception as e:
-            print(f"Session load error: {e}. Falling back to password login...")
-        
-        if not INSTAGRAM_PASSWORD:
-            print("Instagram password not set.")
-            return False
-        
-        try:
-            print(f"Attempting password login as {INSTAGRAM_USERNAME}...")
-            self.loader.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
-            self.logged_in = True
-            print(f"Logged in as {INSTAGRAM_USERNAME}")
-            return True
-        except Exception as e:
-            print(f"Login failed: {e}")
-            return False
+        """Restored cookies, else the instaloader session file, else a password login (see CookieSession)."""
+        return self.session.login()
 
 
+    # URL helpers live in url_service (usable without building the service)
     def get_shortcode_from_url(self, url):
-        # Handle Post/Reel/TV
-        match = re.search(r'instagram\.com\/(?:p|reel|tv)\/([A-Za-z0-9_-]+)', url)
-        if match:
-            return ('post', match.group(1))
-            
-        # Handle Stories
-        # https://instagram.com/stories/username/123456789/
-        match_story = re.search(r'instagram\.com\/stories\/([^\/]+)\/([0-9]+)', url)
-        if match_story:
-            return ('story', (match_story.group(1), match_story.group(2)))
+        return url_service.get_shortcode_from_url(url)
 
-        logging.error(f"Could not parse content from URL: {url}")
-        return None
+    def get_media_key(self, url, content_info=None, playlist_index=None):
+        return url_service.get_media_key(url, content_info, playlist_index)
 
-    def _export_cookies_to_netscape(self, cookie_file_path):
-        """Exports instaloader cookies to a Netscape format cookies.txt for yt-dlp"""
+    # --- yt-dlp session & metadata cache ---
+    def _get_ydl(self, profile):
+        """
+        Long-lived YoutubeDL for the calling thread, one per profile:
+        'meta' (flat info), 'download' and 'stream' (analysis format), 'full' (best resolution).
+        Reusing it keeps HTTP connections across requests; all of them use the session's shared cookie jar.
+
+        Analysis formats are a single video-only file (audio is never downloaded or merged),
+        preferring PREFERRED_VCODEC and the largest height up to ANALYSIS_MAX_HEIGHT.
+        Full-quality frames of the selection are seeked from the 'full' format instead.
+        """
+        import yt_dlp
+
+        # A stale session is renewed before the request rather than after it failed
+        self.session.ensure_valid()
+        instances = self._local.__dict__.setdefault('ydl', {})
+        ydl = instances.get(profile)
+        if ydl is None:
+            ydl_opts = {
+                'quiet': True,
+                'no_warnings': True,
+            }
+            if profile == 'meta':
+                ydl_opts['extract_flat'] = True
+            elif profile == 'full':
+                ydl_opts['format'] = 'bv*/b'
+                ydl_opts['format_sort'] = ['res', f'vcodec:{PREFERRED_VCODEC}']
+            else:
+                # Video-only when available, otherwise the single best file (never a merge)
+                ydl_opts['format'] = 'bv/bv*/b'
+                resolution = f'res:{ANALYSIS_MAX_HEIGHT}' if ANALYSIS_MAX_HEIGHT else 'res'
+                ydl_opts['format_sort'] = [resolution, f'vcodec:{PREFERRED_VCODEC}']
+            ydl = instances[profile] = yt_dlp.YoutubeDL(ydl_opts)
+            # Replaces the jar YoutubeDL would build (lazily) from a cookiefile
+            ydl.cookiejar = self.session.jar
+        return ydl
+
+    @contextmanager
+    def _ydl_params(self, ydl, **params):
+        """Temporarily overrides per-request options (output path, playlist item) on a shared YoutubeDL."""
+        saved = {key: ydl.params.get(key) for key in params}
+        ydl.params.update(params)
         try:
-            with open(cookie_file_path, 'w') as f:
-                f.write("# Netscape HTTP Cookie File\n")
-                f.write("# This file was generated by instagram_service.py\n")
-                
-                for cookie in self.loader.context._session.cookies:
-                    # Netscape format: domain, flag, path, secure, expiration, name, value
-                    domain = cookie.domain
-                    flag = "TRUE" if domain.startswith('.') else "FALSE"
-                    path = cookie.path
-                    secure = "TRUE" if cookie.secure else "FALSE"
-                    expiration = str(int(cookie.expires)) if cookie.expires else "0"
-                    name = cookie.name
-                    value = cookie.value
-                    f.write(f"{domain}\t{flag}\t{path}\t{secure}\t{expiration}\t{name}\t{value}\n")
-            return True
-        except Exception as e:
-            logging.error(f"Failed to export cookies: {e}")
-            return False
+            yield ydl
+        finally:
+            ydl.params.update(saved)
+
+    def normalize_url(self, url):
+        return url_service.normalize_url(url)
+
+    def _cached_info(self, url):
+        key = self.normalize_url(url)
+        with self._meta_lock:
+            item = self._meta_cache.get(key)
+            if item and time.time() - item[0] < META_CACHE_TTL:
+                return item[1]
+            self._meta_cache.pop(key, None)
+        return None
+
+    def _cache_info(self, url, info):
+        now = time.time()
+        with self._meta_lock:
+            for key in [k for k, (ts, _) in self._meta_cache.items() if now - ts >= META_CACHE_TTL]:
+                del self._meta_cache[key]
+            self._meta_cache[self.normalize_url(url)] = (now, info)
+
+    def _cached_entry(self, url, playlist_index=None):
+        """Fully extracted info of the requested video from the metadata cache, or None."""
+        info = self._cached_info(url)
+        if not info:
+            return None
+        if 'entries' in info:
+            entries = info['entries'] or []
+            if not playlist_index or not 0 < playlist_index <= len(entries):
+                return None
+            info = entries[playlist_index - 1]
+        elif playlist_index:
+            return None
+        # Flat url-only entries still need an extraction round-trip
+        if not info or info.get('_type', 'video') != 'video' or not (info.get('formats') or info.get('url')):
+            return None
+        return copy.deepcopy(info)
 
     def check_download_type(self, url):
         """Checks if the URL is a single video or a playlist (story feed)"""
-        import yt_dlp
-        
-        cookie_file = "cookies.txt"
-        if self.logged_in and not os.path.exists(cookie_file):
-             self._export_cookies_to_netscape(cookie_file)
-
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'cookiefile': cookie_file if self.logged_in and os.path.exists(cookie_file) else None,
+        with metrics.span('check_download_type'):
+            info = self._cached_info(url)
+            metrics.inc('cache_requests_total', cache='metadata', result='hit' if info else 'miss')
+            if not info:
+                try:
+                    info = self._get_ydl('meta').extract_info(url, download=False)
+                except Exception as e:
+                    logging.error(f"yt-dlp info fetch failed: {e}")
+                    return {'type': 'error', 'error': str(e)}
+                self._cache_info(url, info)
+
+        if 'entries' in info:
+            return {'type': 'playlist', 'count': len(info['entries']), 'info': info}
+        else:
+            return {'type': 'video', 'info': info}
+
+    def get_stream_info(self, url, playlist_index=None):
+        """
+        Resolves the direct media URL of a video (without downloading it) so it can be streamed
+        into a decoder. playlist_index is 1-based.
+        Returns {'id', 'url', 'http_headers', 'width', 'height', 'fps'} or None.
+        """
+        ydl = self._get_ydl('stream')
+        entry = self._cached_entry(url, playlist_index)
+
+        try:
+            if entry:
+                # Re-run format selection on the cached metadata, no network
+                info = ydl.process_ie_result(entry, download=False)
+            else:
+                with self._ydl_params(ydl, playlist_items=str(playlist_index) if playlist_index else None):
+                    info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            logging.error(f"yt-dlp stream info failed: {e}")
+            return None if playlist_index else self._story_stream_info(url)
+
+        if 'entries' in info:
+            entries = [entry for entry in info['entries'] if entry]
+            info = entries[0] if entries else {}
+
+        # ffmpeg needs a single URL and the frame size to read raw frames
+        if not info.get('url') or not info.get('width') or not info.get('height'):
+            logging.info(f"No streamable format for {url}, falling back to download")
+            return None
+
+        return {
+            'id': info.get('id'),
+            'url': info['url'],
+            'http_headers': info.get('http_headers', {}),
+            'width': info['width'],
+            'height': info['height'],
+            'fps': info.get('fps'),
         }
-        
+
+    def get_full_quality_info(self, url, playlist_index=None):
+        """
+        Direct URL of the highest resolution rendition of a video, for seeking to single frames.
+        playlist_index is 1-based. Returns {'url', 'http_headers', 'width', 'height', 'fps'} or None.
+        """
+        ydl = self._get_ydl('full')
+        entry = self._cached_entry(url, playlist_index)
+
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                if 'entries' in info:
-                    return {'type': 'playlist', 'count': len(info['entries']), 'info': info}
-                else:
-                    return {'type': 'video', 'info': info}
+            if entry:
+                info = ydl.process_ie_result(entry, download=False)
+            else:
+                with self._ydl_params(ydl, playlist_items=str(playlist_index) if playlist_index else None):
+                    info = ydl.extract_info(url, download=False)
         except Exception as e:
-            logging.error(f"yt-dlp info fetch failed: {e}")
-            return {'type': 'error', 'error': str(e)}
+            logging.error(f"yt-dlp full quality info failed: {e}")
+            return None
+
+        if 'entries' in info:
+            entries = [entry for entry in info['entries'] if entry]
+            info = entries[0] if entries else {}
+        if not info.get('url') or not info.get('height'):
+            return None
+        return {
+            'url': info['url'],
+            'http_headers': info.get('http_headers', {}),
+            'width': info.get('width'),
+            'height': info['height'],
+            'fps': info.get('fps'),
+        }
+
+    def _story_stream_info(self, url):
+        """get_stream_info result for a story link, found by the resolver instead of yt-dlp."""
+        parsing_result = self.get_shortcode_from_url(url)
+        if not parsing_result or parsing_result[0] != 'story':
+            return None
+        info = self.resolver.resolve_story(*parsing_result[1])
+        if not info or not info['width'] or not info['height']:
+            return None
+        return {
+            'id': info['id'],
+            'url': info['url'],
+            'http_headers': {'User-Agent': USER_AGENT},
+            'width': info['width'],
+            'height': info['height'],
+            'fps': None,
+        }
 
     def download_with_ytdlp(self, url, target_dir, playlist_index=None):
         """Fallback download using yt-dlp. playlist_index is 1-based."""
-        import yt_dlp
-        
         logging.info(f"Attempting download with yt-dlp for {url} (Index: {playlist_index})")
         
-        cookie_file = "cookies.txt"
-        if self.logged_in:
-            if not os.path.exists(cookie_file):
-                 self._export_cookies_to_netscape(cookie_file)
-        
-        ydl_opts = {
-            'outtmpl': os.path.join(target_dir, '%(id)s.%(ext)s'),
-            'cookiefile': cookie_file if self.logged_in and os.path.exists(cookie_file) else None,
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
-        if playlist_index:
-            ydl_opts['playlist_items'] = str(playlist_index)
+        ydl = self._get_ydl('download')
+        outtmpl = dict(ydl.params['outtmpl'], default=os.path.join(target_dir, '%(id)s.%(ext)s'))
         
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                
-                # If playlist item, info might be the playlist or the item depending on extraction
-                if 'entries' in info:
-                     # If we downloaded specific item from playlist, extract_info might still return playlist structure?
-                     # Actually with playlist_items, it typically returns the info of that item or list of items
-                     pass
+            with self._ydl_params(ydl, outtmpl=outtmpl, playlist_items=str(playlist_index) if playlist_index else None):
+                entry = self._cached_entry(url, playlist_index)
+                if entry:
+                    # Metadata from check_download_type is still fresh: go straight to the format URL
+                    try:
+                        ydl.process_ie_result(entry, download=True)
+                    except Exception as e:
+                        logging.info(f"Cached metadata download failed ({e}), extracting again...")
+                        entry = None
+                if not entry:
+                    ydl.extract_info(url, download=True)
 
                 # Since prompt was for generic download, we rely on file check
                 files = os.listdir(target_dir)
@@ -183,8 +291,10 @@ class InstagramService:
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
 
-        video_path = self.download_with_ytdlp(url, target_dir, playlist_index)
+        with metrics.span('download_with_ytdlp'):
+            video_path = self.download_with_ytdlp(url, target_dir, playlist_index)
         if video_path:
+            metrics.inc('downloaded_bytes_total', os.path.getsize(video_path), source='yt-dlp')
             return video_path
             
         logging.info("yt-dlp failed or returned None, falling back to Instaloader logic (Only for single posts)...")
@@ -193,6 +303,15 @@ class InstagramService:
              logging.error("Instaloader fallback does not support playlist index selection.")
              return None
 
+        metrics.inc('fallbacks_total', kind='instaloader')
+        with metrics.span('instaloader_fallback'):
+            video_path = self.download_with_instaloader(url, target_dir)
+        if video_path:
+            metrics.inc('downloaded_bytes_total', os.path.getsize(video_path), source='instaloader')
+        return video_path
+
+    def download_with_instaloader(self, url, target_dir):
+        """Downloads a single post or story item with instaloader (no playlist support)."""
         parsing_result = self.get_shortcode_from_url(url)
         if not parsing_result:
             logging.error(f"Aborting download: Invalid URL format for {url}")
@@ -217,6 +336,12 @@ class InstagramService:
                 username, story_id = content_data
                 logging.info(f"Fetching story {story_id} from user {username}...")
                 
+                # Media info and story reel are looked up concurrently, the first hit is streamed to disk
+                video_path = self.resolver.download_story(username, story_id, target_dir)
+                if video_path:
+                    return video_path
+                logging.info("Resolver couldn't get the story, walking the story feed with instaloader...")
+                
                 # To download a story, we often need to iterate the user's stories
                 # This requires login (which we have) and the target user being public or followed
                 
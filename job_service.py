@@ -0,0 +1,166 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import IO_WORKERS, CPU_WORKERS, MAX_ACTIVE_JOBS, MAX_QUEUED_JOBS
+
+
+class QueueFullError(Exception):
+    """Raised when too many jobs are already waiting for a slot."""
+    pass
+
+
+class JobService:
+    """
+    Runs blocking work off the asyncio event loop.
+    - IO pool (threads): network-bound yt-dlp / instaloader calls.
+    - CPU pool (processes): OpenCV decoding and frame scoring.
+    - Job slots: limits how many user requests run at once, with a bounded waiting line.
+    """
+    def __init__(self, io_workers=IO_WORKERS, cpu_workers=CPU_WORKERS,
+                 max_active=MAX_ACTIVE_JOBS, max_queued=MAX_QUEUED_JOBS):
+        self.io_workers = max(1, io_workers)
+        self.cpu_workers = max(1, cpu_workers)
+        self.max_active = max(1, max_active)
+        self.max_queued = max(0, max_queued)
+
+        # Pools are created lazily so importing this module stays cheap
+        self._io_executor = None
+        self._cpu_executor = None
+
+        # Asyncio primitives must be created inside the running loop
+        self._io_limit = None
+        self._cpu_limit = None
+        self._slots = None
+
+        self.active = 0
+        self._jobs = {} # chat_id -> asyncio.Task (submitted, not finished)
+        self._slotless = set() # Tasks of _jobs submitted with needs_slot=False
+
+    # --- Pools ---
+    def _ensure_primitives(self):
+        if self._slots is None:
+            self._io_limit = asyncio.Semaphore(self.io_workers)
+            self._cpu_limit = asyncio.Semaphore(self.cpu_workers)
+            self._slots = asyncio.Semaphore(self.max_active)
+
+    @property
+    def io_executor(self):
+        if self._io_executor is None:
+            self._io_executor = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="io")
+        return self._io_executor
+
+    @property
+    def cpu_executor(self):
+        if self._cpu_executor is None:
+            self._cpu_executor = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        return self._cpu_executor
+
+    async def run_io(self, func, *args, **kwargs):
+        """Runs a blocking network call in the IO thread pool."""
+        self._ensure_primitives()
+        loop = asyncio.get_running_loop()
+        async with self._io_limit:
+            return await loop.run_in_executor(self.io_executor, functools.partial(func, *args, **kwargs))
+
+    async def warm_up(self):
+        """Starts the CPU worker processes ahead of the first job."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.cpu_executor, os.getpid) for _ in range(self.cpu_workers)))
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """Runs CPU-heavy work in the process pool. func and args must be picklable."""
+        self._ensure_primitives()
+        loop = asyncio.get_running_loop()
+        async with self._cpu_limit:
+            return await loop.run_in_executor(self.cpu_executor, functools.partial(func, *args, **kwargs))
+
+    def cpu_share(self):
+        """CPU workers a single job should use at once: the pool split evenly between running jobs."""
+        return max(1, self.cpu_workers // max(1, self.active))
+
+    # --- Jobs ---
+    @property
+    def waiting(self):
+        """Jobs submitted but not yet holding a slot."""
+        return max(0, self._slotted() - self.max_active)
+
+    def _slotted(self):
+        return len([task for task in self._jobs.values() if task not in self._slotless])
+
+    def queue_position(self):
+        """1-based position a new job would get in the waiting line (0 = starts immediately)."""
+        if self._slotted() < self.max_active:
+            return 0
+        return self.waiting + 1
+
+    def submit(self, chat_id, coro, on_queued=None, needs_slot=True):
+        """
+        Schedules a job for a chat and returns its task.
+        Any previous job of the same chat is cancelled (user sent a new link).
+        on_queued(position) is awaited if the job has to wait for a free slot.
+        needs_slot=False runs it right away outside the slots (it only waits for another job's result).
+        Raises QueueFullError if the waiting line is full.
+        """
+        self._ensure_primitives()
+        self.cancel(chat_id)
+
+        if not needs_slot:
+            task = asyncio.get_running_loop().create_task(coro)
+            self._slotless.add(task)
+            task.add_done_callback(lambda t: self._forget(chat_id, t, coro))
+            self._jobs[chat_id] = task
+            return task
+
+        position = self.queue_position()
+        if position > self.max_queued:
+            coro.close()
+            raise QueueFullError(f"{self.waiting} jobs already waiting")
+
+        task = asyncio.get_running_loop().create_task(self._run(chat_id, coro, position, on_queued))
+        task.add_done_callback(lambda t: self._forget(chat_id, t, coro))
+        self._jobs[chat_id] = task
+        return task
+
+    def current(self, chat_id):
+        """The submitted, unfinished job of a chat (or None)."""
+        return self._jobs.get(chat_id)
+
+    def cancel(self, chat_id):
+        """Cancels the running or waiting job of a chat. Returns True if one was cancelled."""
+        task = self._jobs.pop(chat_id, None)
+        if task and not task.done():
+            logging.info(f"Cancelling previous job for chat {chat_id}")
+            task.cancel()
+            return True
+        return False
+
+    def _forget(self, chat_id, task, coro):
+        if self._jobs.get(chat_id) is task:
+            del self._jobs[chat_id]
+        self._slotless.discard(task)
+        # No-op if the coroutine ran; avoids "never awaited" warnings if cancelled while waiting
+        coro.close()
+        if not task.cancelled() and task.exception():
+            logging.error(f"Job for chat {chat_id} failed: {task.exception()}")
+
+    async def _run(self, chat_id, coro, position, on_queued):
+        if position and on_queued:
+            await on_queued(position)
+
+        async with self._slots:
+            self.active += 1
+            try:
+                return await coro
+            except asyncio.CancelledError:
+                logging.info(f"Job for chat {chat_id} cancelled")
+                raise
+            finally:
+                self.active -= 1
+
+    def shutdown(self):
+        if self._io_executor:
+            self._io_executor.shutdown(wait=False)
+        if self._cpu_executor:
+            self._cpu_executor.shutdown(wait=False)
@@ -0,0 +1,157 @@
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "insta_frame_bot_"
+# Upper bounds (seconds) of the stage latency histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Metrics:
+    """
+    Minimal thread-safe metrics registry rendered in the Prometheus text format (served on /metrics).
+    - Counters / gauges / histograms are keyed by name and labels.
+    - Collectors are called at scrape time for values owned by other services (queue depth, disk usage).
+    CPU work runs in worker processes, so analysis timings come back in the stats dict and are
+    recorded here by the caller (record_analysis).
+    """
+    def __init__(self, prefix=PREFIX, buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._kinds = {} # name -> (type, help)
+        self._values = {} # (name, labels) -> value (counters, gauges)
+        self._histograms = {} # (name, labels) -> [count per bucket..., sum, count]
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._kinds[name] = (kind, help_text)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Times a pipeline stage into the stage_seconds histogram (also when it raises)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def add_collector(self, collect):
+        """collect() -> iterable of (name, value, labels dict), read at scrape time."""
+        self._collectors.append(collect)
+
+    # --- Exposition ---
+    def _name(self, name):
+        return self.prefix + name
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        values = {}
+        for collect in self._collectors:
+            try:
+                for name, value, labels in collect():
+                    values[self._key(name, labels)] = value
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+
+        with self._lock:
+            values.update(self._values)
+            histograms = {key: list(h) for key, h in self._histograms.items()}
+
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), histogram in histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text = self._kinds.get(name, ('untyped', name))
+            full = self._name(name)
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f"{full}{self._labels(labels)} {value}")
+                    continue
+                for bound, count in zip(self.buckets, value):
+                    lines.append(f"{full}_bucket{self._labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{full}_bucket{self._labels(labels, [('le', '+Inf')])} {value[-1]}")
+                lines.append(f"{full}_sum{self._labels(labels)} {value[-2]}")
+                lines.append(f"{full}_count{self._labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def rss_bytes():
+    """Resident memory of this process (peak RSS where /proc isn't available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record_analysis(stats):
+    """Records the decode / score split and frame counts of an analysis result's stats."""
+    if not stats:
+        return
+    metrics.observe('stage_seconds', stats.get('decode_seconds', 0.0), stage='analyze_decode')
+    metrics.observe('stage_seconds', stats.get('score_seconds', 0.0), stage='analyze_score')
+    metrics.inc('frames_decoded_total', stats.get('frames_decoded', 0))
+    metrics.inc('frames_retrieved_total', stats.get('frames_retrieved', 0))
+    metrics.inc('frames_scored_total', stats.get('frames_scored', 0))
+
+
+metrics = Metrics()
+metrics.describe('stage_seconds', 'histogram', "Time spent in each pipeline stage")
+metrics.describe('cache_requests_total', 'counter', "Cache lookups by cache and result (hit/miss)")
+metrics.describe('fallbacks_total', 'counter', "Times a slower fallback path was taken")
+metrics.describe('downloaded_bytes_total', 'counter', "Video bytes downloaded, by downloader")
+metrics.describe('frames_decoded_total', 'counter', "Video frames decoded for analysis")
+metrics.describe('frames_retrieved_total', 'counter', "Decoded frames converted to images for analysis")
+metrics.describe('frames_scored_total', 'counter', "Video frames scored for sharpness")
+metrics.describe('rate_limited_total', 'counter', "Links rejected by the per-chat rate limit")
+metrics.describe('coalesced_requests_total', 'counter', "Requests that joined another chat's in-flight request")
+metrics.describe('webhook_requests_total', 'counter', "Webhook requests by result (accepted/forbidden/invalid)")
+metrics.describe('jobs_active', 'gauge', "Link jobs holding a processing slot")
+metrics.describe('jobs_waiting', 'gauge', "Link jobs waiting for a processing slot")
+metrics.describe('temp_disk_bytes', 'gauge', "Bytes used by request directories")
+metrics.describe('result_cache_bytes', 'gauge', "Bytes used by the result cache")
+metrics.describe('process_resident_memory_bytes', 'gauge', "Resident memory of the bot process")
+metrics.describe('startup_seconds', 'gauge', "Import / init time of services built after startup, by service and stage")
+metrics.add_collector(lambda: [('process_resident_memory_bytes', rss_bytes(), {})])
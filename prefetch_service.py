@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import os
+from config import PREFETCH_CONCURRENCY, PREFETCH_MAX_ITEMS, PREFETCH_USER_BYTES, PREFETCH_GLOBAL_BYTES
+
+
+class PrefetchService:
+    """
+    Downloads and analyzes the items of a story playlist in the background, right after
+    the playlist is detected, so tapping a "Story N" button returns almost instantly.
+    - At most `concurrency` items are fetched at the same time (across all chats).
+    - Prefetched bytes are capped per chat and globally; items over the cap are skipped.
+    - A chat's unused prefetches are cancelled and deleted when it moves on.
+    """
+    def __init__(self, jobs, insta, analyzer, storage, concurrency=PREFETCH_CONCURRENCY,
+                 max_items=PREFETCH_MAX_ITEMS, user_bytes=PREFETCH_USER_BYTES, global_bytes=PREFETCH_GLOBAL_BYTES):
+        self.jobs = jobs
+        self.insta = insta
+        self.analyzer = analyzer
+        self.storage = storage
+        self.concurrency = max(1, concurrency)
+        self.max_items = max_items
+        self.user_bytes = user_bytes
+        self.global_bytes = global_bytes
+        self.total_bytes = 0
+        self._limit = None # Created inside the running loop
+        self._sessions = {} # chat_id -> {'url', 'tasks': {index: Task}, 'dirs': {index: dir}, 'sizes': {index: bytes}}
+
+    def _over_cap(self, session):
+        return sum(session['sizes'].values()) >= self.user_bytes or self.total_bytes >= self.global_bytes
+
+    def start(self, chat_id, url, count):
+        """Starts prefetching items 1..count of a playlist for a chat (replacing any previous prefetch)."""
+        self.cancel(chat_id)
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+
+        session = {'url': url, 'tasks': {}, 'dirs': {}, 'sizes': {}}
+        self._sessions[chat_id] = session
+        loop = asyncio.get_running_loop()
+        for index in range(1, min(count, self.max_items) + 1):
+            session['tasks'][index] = loop.create_task(self._fetch(session, index))
+        logging.info(f"Prefetching {len(session['tasks'])} stories for chat {chat_id}")
+
+    async def _fetch(self, session, index):
+        try:
+            return await self._fetch_item(session, index)
+        except Exception as e:
+            logging.error(f"Prefetch of story {index} failed: {e}")
+            self._discard(session, index)
+            return None
+
+    async def _fetch_item(self, session, index):
+        async with self._limit:
+            if self._over_cap(session):
+                logging.info(f"Prefetch cap reached, skipping story {index}")
+                return None
+
+            temp_dir = self.storage.create()
+            session['dirs'][index] = temp_dir
+
+            video_path = await self.jobs.run_io(self.insta.download_post, session['url'], temp_dir, playlist_index=index)
+            if not video_path:
+                self._discard(session, index)
+                return None
+
+            self.storage.refresh(temp_dir)
+            size = os.path.getsize(video_path)
+            session['sizes'][index] = size
+            self.total_bytes += size
+            if self._over_cap(session):
+                logging.info(f"Prefetched story {index} ({size} bytes) exceeds the cap, dropping it")
+                self._discard(session, index)
+                return None
+
+        # Scoring runs outside the download limit, it has its own CPU pool limit
+        result = await self.analyzer.analyze(video_path)
+        # Nobody may ask for it: the quota can reclaim it until it is taken
+        self.storage.unpin(temp_dir)
+        return {'video_path': video_path, 'temp_dir': temp_dir, 'result': result}
+
+    def _discard(self, session, index):
+        self.total_bytes -= session['sizes'].pop(index, 0)
+        self.storage.release(session['dirs'].pop(index, None))
+
+    async def take(self, chat_id, url, index):
+        """
+        Claims a prefetched story (waiting for it if it is still in progress).
+        Returns {'video_path', 'temp_dir', 'result'} or None if it wasn't prefetched.
+        The caller owns the returned temp_dir.
+        """
+        session = self._sessions.get(chat_id)
+        if not session or session['url'] != url or index not in session['tasks']:
+            return None
+
+        task = session['tasks'].pop(index)
+        try:
+            item = await task
+        except asyncio.CancelledError:
+            if task.cancelled():
+                # Prefetch was cancelled, not the caller
+                return None
+            raise
+
+        # No longer counted as prefetched: it belongs to the user's session now
+        self.total_bytes -= session['sizes'].pop(index, 0)
+        session['dirs'].pop(index, None)
+        if item and not self.storage.pin(item['temp_dir']):
+            # Evicted by the storage quota in the meantime
+            return None
+        return item
+
+    def cancel(self, chat_id):
+        """Cancels a chat's unclaimed prefetches and deletes their files."""
+        session = self._sessions.pop(chat_id, None)
+        if not session:
+            return
+        for task in session['tasks'].values():
+            task.cancel()
+        for index in list(session['dirs']):
+            self._discard(session, index)
+        logging.info(f"Cancelled prefetch for chat {chat_id}")
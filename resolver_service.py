@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import threading
+import httpx
+from config import RESOLVER_MAX_CONNECTIONS, RESOLVER_TIMEOUT, DOWNLOAD_CHUNK_BYTES
+from metrics_service import metrics
+
+API_URL = "https://i.instagram.com/api/v1"
+# Public app id the Instagram web client sends with its API calls
+APP_ID = "936619743392459"
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+
+
+class MediaResolver:
+    """
+    Finds and downloads story items over Instagram's web API with one pooled async HTTP client,
+    for when yt-dlp can't get a story.
+    - The media info lookup (by the ID in the link) and the profile -> story reel lookup run
+      concurrently; the first one that finds the item wins and the other is cancelled.
+    - The mp4 is streamed to disk in chunks.
+    - Requests carry the logged-in session's cookies: the client uses the shared jar itself (cookie_jar).
+    The client lives on its own event loop thread, so the blocking entry points (resolve_story,
+    download_story) can be called from JobService IO threads.
+    """
+    def __init__(self, cookie_jar, max_connections=RESOLVER_MAX_CONNECTIONS, timeout=RESOLVER_TIMEOUT,
+                 chunk_size=DOWNLOAD_CHUNK_BYTES):
+        self.cookie_jar = cookie_jar
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._loop = None
+        self._client = None
+
+    # --- Event loop / client ---
+    def _run(self, coro):
+        """Runs a coroutine on the resolver loop and waits for its result."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True, name="media-resolver").start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout, follow_redirects=True, cookies=self.cookie_jar,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                headers={'User-Agent': USER_AGENT, 'X-IG-App-ID': APP_ID},
+            )
+        # The session may have been renewed since the last request
+        csrf_token = next((cookie.value for cookie in self.cookie_jar if cookie.name == 'csrftoken'), None)
+        if csrf_token:
+            self._client.headers['X-CSRFToken'] = csrf_token
+        return self._client
+
+    async def _get_json(self, path, **params):
+        response = await self._get_client().get(f"{API_URL}{path}", params=params)
+        response.raise_for_status()
+        return response.json()
+
+    # --- Lookups ---
+    async def _from_media_info(self, media_id):
+        data = await self._get_json(f"/media/{media_id}/info/")
+        items = data.get('items') or []
+        return items[0] if items else None
+
+    async def _from_reel(self, username, media_id):
+        data = await self._get_json("/users/web_profile_info/", username=username)
+        user_id = data['data']['user']['id']
+        data = await self._get_json("/feed/reels_media/", reel_ids=user_id)
+        reels = data.get('reels') or {}
+        for reel in (reels.values() if reels else data.get('reels_media') or []):
+            for item in reel.get('items') or []:
+                if str(item.get('pk')) == media_id:
+                    return item
+        return None
+
+    async def find_story_item(self, username, media_id):
+        """Story item dict, or None if neither lookup found it."""
+        lookups = [asyncio.ensure_future(self._from_media_info(media_id)),
+                   asyncio.ensure_future(self._from_reel(username, media_id))]
+        try:
+            for lookup in asyncio.as_completed(lookups):
+                try:
+                    item = await lookup
+                except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+                    logging.info(f"Story lookup for {media_id} failed: {type(e).__name__}: {e}")
+                    continue
+                if item:
+                    return item
+            return None
+        finally:
+            for lookup in lookups:
+                lookup.cancel()
+
+    @staticmethod
+    def video_info(item):
+        """{'id', 'url', 'width', 'height'} of the largest video version of an item, or None for photos."""
+        versions = (item or {}).get('video_versions') or []
+        if not versions:
+            return None
+        best = max(versions, key=lambda version: (version.get('width') or 0) * (version.get('height') or 0))
+        return {'id': str(item.get('pk')), 'url': best['url'], 'width': best.get('width'), 'height': best.get('height')}
+
+    async def download(self, url, path):
+        """Streams url to path in chunks. Returns the number of bytes written."""
+        written = 0
+        async with self._get_client().stream('GET', url) as response:
+            response.raise_for_status()
+            with open(path + ".part", 'wb') as f:
+                async for chunk in response.aiter_bytes(self.chunk_size):
+                    f.write(chunk)
+                    written += len(chunk)
+        os.replace(path + ".part", path)
+        return written
+
+    # --- Blocking entry points ---
+    def resolve_story(self, username, media_id):
+        """Video info (see video_info) of a story item, or None."""
+        with metrics.span('resolve_story'):
+            item = self._run(self.find_story_item(username, media_id))
+        if not item:
+            logging.info(f"Story {media_id} of {username} not found by the resolver")
+            return None
+        info = self.video_info(item)
+        if not info:
+            logging.warning(f"Story {media_id} is not a video.")
+        return info
+
+    def download_story(self, username, media_id, target_dir):
+        """Downloads a story video to target_dir. Returns its path, or None."""
+        info = self.resolve_story(username, media_id)
+        if not info:
+            return None
+        path = os.path.join(target_dir, f"{media_id}.mp4")
+        try:
+            self._run(self.download(info['url'], path))
+        except (httpx.HTTPError, OSError) as e:
+            logging.error(f"Story download failed: {type(e).__name__}: {e}")
+            return None
+        return path
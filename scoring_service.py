@@ -0,0 +1,128 @@
+import time
+import cv2
+import numpy as np
+from config import SCORING_HEIGHT
+
+# Same weighting as VideoService.get_blur_score: 70% Center, 30% Global
+CENTER_WEIGHT = 0.7
+GLOBAL_WEIGHT = 0.3
+
+
+class SharpnessScorer:
+    """
+    Fast center-weighted Laplacian variance scorer.
+    - Frames are converted to grayscale once, at a working resolution (SCORING_HEIGHT).
+    - Buffers are allocated once per frame size and reused for every frame.
+    - A single Laplacian pass feeds both the global and the center variance (region sums),
+      instead of running a second convolution over the center crop.
+    Scores are comparable to VideoService.get_blur_score at the same resolution
+    (only the 1px image border and the center crop edges are treated differently).
+    signature() returns a 64-bit difference hash of the last scored frame, reusing its
+    grayscale buffer, for scene-cut and near-duplicate detection.
+    """
+    def __init__(self, work_height=SCORING_HEIGHT):
+        self.work_height = work_height
+        self.seconds = 0.0 # Time spent in score() / signature(), for decode vs score stats
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        self._shape = None # (h, w) of the working frame
+        self._small = None
+        self._gray = None
+        self._blur = None
+        self._lap = None
+
+    def __getstate__(self):
+        # Don't ship scratch buffers to worker processes
+        return {'work_height': self.work_height}
+
+    def __setstate__(self, state):
+        self.work_height = state['work_height']
+        self.seconds = 0.0
+        self._reset_buffers()
+
+    # --- Preparation ---
+    def _work_size(self, frame):
+        h, w = frame.shape[:2]
+        if self.work_height and h > self.work_height:
+            return self.work_height, max(1, int(round(w * self.work_height / h)))
+        return h, w
+
+    def _ensure_buffers(self, h, w):
+        if self._shape != (h, w):
+            self._reset_buffers()
+            self._shape = (h, w)
+            self._small = np.empty((h, w, 3), dtype=np.uint8)
+            self._gray = np.empty((h, w), dtype=np.uint8)
+            self._blur = np.empty((h, w), dtype=np.uint8)
+            self._lap = np.empty((h, w), dtype=np.float32)
+
+    def _to_gray(self, frame, out):
+        """Downscales (if needed), converts to grayscale and denoises into `out`."""
+        h, w = self._shape
+        if frame.ndim == 2:
+            gray = frame
+            if frame.shape != (h, w):
+                gray = cv2.resize(frame, (w, h), dst=self._gray, interpolation=cv2.INTER_AREA)
+        else:
+            if frame.shape[:2] != (h, w):
+                # Resize the color frame first: cheaper than converting the full-size frame
+                frame = cv2.resize(frame, (w, h), dst=self._small, interpolation=cv2.INTER_AREA)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        # Slight blur to ignore high-ISO noise which mimics sharpness
+        cv2.GaussianBlur(gray, (3, 3), 0, dst=out)
+        return out
+
+    def _center_box(self):
+        """Center 50% crop, in coordinates of the Laplacian interior (1px border removed)."""
+        h, w = self._shape
+        crop_h, crop_w = h // 2, w // 2
+        start_y = h // 2 - crop_h // 2
+        start_x = w // 2 - crop_w // 2
+        return start_y - 1, start_y - 1 + crop_h, start_x - 1, start_x - 1 + crop_w
+
+    # --- Scoring ---
+    def score(self, frame):
+        """Scores a single BGR (or grayscale) frame."""
+        start = time.perf_counter()
+        try:
+            return self._score(frame)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def _score(self, frame):
+        if frame is None:
+            return 0.0
+
+        h, w = self._work_size(frame)
+        if h < 3 or w < 3:
+            return 0.0
+        self._ensure_buffers(h, w)
+
+        blurred = self._to_gray(frame, self._blur)
+        cv2.Laplacian(blurred, cv2.CV_32F, dst=self._lap)
+
+        interior = self._lap[1:-1, 1:-1]
+        y0, y1, x0, x1 = self._center_box()
+        _, global_std = cv2.meanStdDev(interior)
+        _, center_std = cv2.meanStdDev(interior[y0:y1, x0:x1])
+
+        return float(CENTER_WEIGHT * center_std[0, 0] ** 2 + GLOBAL_WEIGHT * global_std[0, 0] ** 2)
+
+    def signature(self):
+        """
+        dHash of the last frame passed to score(): the frame shrunk to 9x8 and one bit per
+        horizontally adjacent pair (left brighter than right). Similar frames differ in few bits.
+        """
+        if self._shape is None:
+            return 0
+        start = time.perf_counter()
+        small = cv2.resize(self._blur, (9, 8), interpolation=cv2.INTER_AREA)
+        bits = np.packbits(small[:, :-1] > small[:, 1:])
+        self.seconds += time.perf_counter() - start
+        return int.from_bytes(bits.tobytes(), 'big')
+
+
+def signature_distance(a, b):
+    """Number of differing bits between two signatures."""
+    return bin(a ^ b).count('1')
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from config import SEGMENT_WORKERS, SEGMENT_MIN_SECONDS, ANALYSIS_STRATEGY
+from metrics_service import record_analysis
+
+
+class SegmentAnalyzer:
+    """
+    Full analysis of a video, using several CPU worker processes for long clips.
+    - The clip is split into keyframe-aligned segments (VideoService.plan_segments).
+    - Each segment is decoded and scored by its own worker, with its own VideoCapture.
+    - Per-segment top candidates are merged with the same min_distance rule (VideoService.merge_segments).
+    Segments go through JobService.run_cpu like any other CPU work, and one video never takes
+    more than its share of the pool, so a long upload can't starve other chats.
+    """
+    def __init__(self, jobs, video_processor, workers=SEGMENT_WORKERS, min_segment_seconds=SEGMENT_MIN_SECONDS):
+        self.jobs = jobs
+        self.video_processor = video_processor
+        self.workers = max(1, workers)
+        self.min_segment_seconds = min_segment_seconds
+
+    async def analyze(self, video_path):
+        """Same result as VideoService.analyze_video_result."""
+        result = await self._analyze(video_path)
+        record_analysis(result['stats'])
+        return result
+
+    async def _analyze(self, video_path):
+        workers = min(self.workers, self.jobs.cpu_share())
+        plan = None
+        # The sampled strategy seeks around global peaks, it isn't split
+        if workers > 1 and ANALYSIS_STRATEGY != "sampled":
+            plan = await self.jobs.run_io(self.video_processor.plan_segments, video_path, workers, self.min_segment_seconds)
+
+        if not plan or len(plan['segments']) < 2:
+            return await self.jobs.run_cpu(self.video_processor.analyze_video_result, video_path)
+
+        logging.info(f"Analyzing {video_path} in {len(plan['segments'])} segments "
+                     f"(keyframe aligned: {plan['keyframe_aligned']})")
+        parts = await asyncio.gather(*(
+            self.jobs.run_cpu(self.video_processor.analyze_segment, video_path, start, end, plan['min_distance'])
+            for start, end in plan['segments']
+        ))
+        return await self.jobs.run_io(self.video_processor.merge_segments, plan, parts)
@@ -0,0 +1,180 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from config import SESSION_BACKEND, SESSION_DB, SESSION_CACHE_SIZE, SESSION_TTL
+
+
+class Session(dict):
+    """
+    Conversation state of one chat (what used to live in context.user_data).
+    Only PERSISTED keys are written to the persistent backend, in compact form:
+    ranked candidates / displayed frames become arrays of frame indices and float32 scores.
+    Everything else (rendered frames, background refinement) only lives in this process
+    and is rebuilt on demand when the session was loaded from the backend.
+    """
+    PERSISTED = ('all_candidates', 'displayed_frames', 'shown_count', 'awaiting_selection', 'video_path',
+                 'temp_dir', 'media_key', 'source_url', 'source_index', 'pending_playlist_url',
+                 'pending_playlist_info')
+
+    def __init__(self, chat_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_id = chat_id
+        self.version = None # Of the backend row this session was loaded from / saved as
+        self.accessed = time.time()
+
+    def encode(self):
+        data = {key: self[key] for key in self.PERSISTED if self.get(key) is not None}
+        for key in ('all_candidates', 'displayed_frames'):
+            if key in data:
+                # Previews of displayed frames aren't kept
+                data[key] = (array('i', [item[0] for item in data[key]]), array('f', [item[1] for item in data[key]]))
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def decode(cls, chat_id, version, blob):
+        session = cls(chat_id, pickle.loads(blob))
+        if 'all_candidates' in session:
+            session['all_candidates'] = list(zip(*session['all_candidates']))
+        if 'displayed_frames' in session:
+            session['displayed_frames'] = [(idx, score, None) for idx, score in zip(*session['displayed_frames'])]
+        session.version = version
+        return session
+
+    def close(self):
+        """Stops the session's background work (it expired or was evicted)."""
+        task = self.pop('refine_task', None)
+        if task:
+            task.cancel()
+
+
+class SqliteSessionBackend:
+    """
+    Sessions persisted in a local SQLite file: they survive restarts, and bot processes on the
+    same host share them (WAL mode). Rows expire `ttl` seconds after their last save.
+    """
+    PURGE_EVERY = 100 # Saves between two deletes of expired rows
+
+    def __init__(self, path=SESSION_DB, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._saves = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(chat_id INTEGER PRIMARY KEY, version INTEGER, expires REAL, data BLOB)")
+        self.purge()
+
+    def load(self, chat_id):
+        """Returns (version, data) or None."""
+        with self._lock:
+            return self._db.execute("SELECT version, data FROM sessions WHERE chat_id = ? AND expires > ?",
+                                    (chat_id, time.time())).fetchone()
+
+    def save(self, chat_id, version, data):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO sessions (chat_id, version, expires, data) VALUES (?, ?, ?, ?)",
+                             (chat_id, version, time.time() + self.ttl, data))
+            self._saves += 1
+        if self._saves % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def purge(self):
+        with self._lock:
+            removed = self._db.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+        if removed:
+            logging.info(f"Session store: removed {removed} expired sessions")
+
+
+class SessionStore:
+    """
+    Sessions by chat ID.
+    - In memory: an LRU of at most `max_sessions`, each expiring after `ttl` seconds without use,
+      so idle chats don't grow the process.
+    - With a persistent backend every save is also written there, and a chat missing from memory
+      (after a restart, an eviction, or a chat last served by another process) is loaded from it.
+      Only that miss does backend I/O: cached() answers from memory alone, so the event loop can
+      use it and leave get() for a thread.
+    - on_load(session) is called for every session decoded from the backend, e.g. to claim
+      resources (its temp dir) that this process didn't create.
+    Handlers must call save() after changing persisted keys.
+    """
+    def __init__(self, backend=None, max_sessions=SESSION_CACHE_SIZE, ttl=SESSION_TTL, on_load=None):
+        self.backend = backend
+        self.on_load = on_load
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict() # chat_id -> Session
+
+    def cached(self, chat_id):
+        """The chat's session if it is in memory, else None. No I/O."""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is None:
+                return None
+            if now - session.accessed > self.ttl:
+                del self._sessions[chat_id]
+                session.close()
+                return None
+            session.accessed = now
+            self._sessions.move_to_end(chat_id)
+            return session
+
+    def get(self, chat_id):
+        """The chat's session: from memory, else from the backend, else a new one. May block on the backend."""
+        session = self.cached(chat_id)
+        if session is not None:
+            return session
+
+        loaded = None
+        if self.backend:
+            row = self.backend.load(chat_id)
+            if row is not None:
+                loaded = Session.decode(chat_id, *row)
+        with self._lock:
+            # Another thread may have loaded it meanwhile
+            session = self._sessions.get(chat_id)
+            if session is None:
+                session = loaded or Session(chat_id)
+                self._sessions[chat_id] = session
+            else:
+                loaded = None
+            session.accessed = time.time()
+            self._sessions.move_to_end(chat_id)
+            self._evict()
+        if loaded is not None and self.on_load:
+            self.on_load(loaded)
+        return session
+
+    def save(self, session):
+        session.accessed = time.time()
+        if self.backend:
+            session.version = time.time_ns()
+            self.backend.save(session.chat_id, session.version, session.encode())
+
+    def _evict(self):
+        """Drops sessions past max_sessions or idle past ttl (least recently used first)."""
+        now = time.time()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - session.accessed <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def create_session_store(on_load=None):
+    """SessionStore for the SESSION_BACKEND setting ("memory" or "sqlite")."""
+    if SESSION_BACKEND == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(SESSION_DB)), exist_ok=True)
+        return SessionStore(SqliteSessionBackend(), on_load=on_load)
+    return SessionStore(on_load=on_load)
@@ -0,0 +1,100 @@
+import asyncio
+import importlib
+import logging
+import threading
+import time
+from metrics_service import metrics
+
+
+class LazyService:
+    """
+    A service that is imported and constructed on first use instead of when bot.py is imported.
+    - factory(module) builds the service from its (then imported) module.
+    - Attribute access is forwarded to the built service, so call sites use it like the service itself
+      (bound methods handed to worker pools are the service's own, and pickle as before).
+      LazyService's own attributes (service_name, built, build, warm...) are chosen not to shadow the services'.
+    - warm() builds it ahead of time from a background thread; a handler that gets there first
+      waits for the same build instead of starting another one.
+    - Code on the event loop awaits ready() before using it: a build (its own, or warm-up's
+      holding the lock) then runs or is waited for in a thread, never on the loop itself.
+    Import and init times are logged and exported as startup_seconds.
+    """
+    def __init__(self, name, module, factory):
+        self.service_name = name
+        self.startup_timings = None # {'import': seconds, 'init': seconds} once built
+        self._module = module
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._service = None
+
+    @property
+    def built(self):
+        return self._service is not None
+
+    def build(self):
+        """The service, built now if it wasn't yet."""
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._service = self._create()
+        return self._service
+
+    def _create(self):
+        started = time.perf_counter()
+        module = importlib.import_module(self._module)
+        imported = time.perf_counter()
+        service = self._factory(module)
+        created = time.perf_counter()
+
+        self.startup_timings = {'import': imported - started, 'init': created - imported}
+        for stage, seconds in self.startup_timings.items():
+            metrics.set('startup_seconds', seconds, service=self.service_name, stage=stage)
+        logging.info(f"Started {self.service_name} in {created - started:.2f}s "
+                     f"(import {imported - started:.2f}s, init {created - imported:.2f}s)")
+        return service
+
+    async def warm(self):
+        """Builds the service in a thread, without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.build)
+
+    async def ready(self):
+        """The service, once built (see warm). Free when it already is."""
+        if self._service is None:
+            await self.warm()
+        return self._service
+
+    def __getattr__(self, name):
+        # Only called for attributes LazyService doesn't have itself
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.build(), name)
+
+
+async def ready(services):
+    """Awaits LazyService.ready() of the given services (anything else, e.g. a test double, is skipped)."""
+    for service in services:
+        if isinstance(service, LazyService):
+            await service.ready()
+
+
+async def warm_up(services, jobs=None):
+    """
+    Builds the given services one after the other (a single import lock makes parallel imports moot),
+    then starts the CPU worker processes so the first analysis doesn't pay for them.
+    Services that are already built (or aren't LazyServices, e.g. test doubles) are skipped.
+    """
+    started = time.perf_counter()
+    for service in services:
+        if isinstance(service, LazyService) and not service.built:
+            try:
+                await service.warm()
+            except Exception as e:
+                # Retried on first use, where the error reaches the handler
+                logging.error(f"Warming up {service.service_name} failed: {e}")
+    if jobs:
+        pool_started = time.perf_counter()
+        await jobs.warm_up()
+        metrics.set('startup_seconds', time.perf_counter() - pool_started, service='cpu_pool', stage='init')
+    seconds = time.perf_counter() - started
+    metrics.set('startup_seconds', seconds, service='all', stage='warm_up')
+    logging.info(f"Warm-up done in {seconds:.2f}s")
@@ -0,0 +1,176 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from config import TEMP_DIR, TEMP_MAX_BYTES, TEMP_IDLE_TTL, TEMP_PINNED_TTL, TEMP_SWEEP_INTERVAL
+
+
+class StorageManager:
+    """
+    Owns the per-request directories under temp_downloads.
+    - Every directory is tracked in memory with its size and last access time.
+    - Past `max_bytes`, the least recently used unpinned directories are deleted right away.
+    - New directories start pinned: their request is still downloading / analyzing into them.
+      They stay pinned while their session is live (awaiting_selection) and are only unpinned
+      once the chat moves on, so space is never reclaimed from work in progress.
+    - Finished requests release their directory immediately; the background sweep only
+      catches what was abandoned (idle past `idle_ttl`, or `pinned_ttl` for pinned ones).
+    """
+    def __init__(self, root=TEMP_DIR, max_bytes=TEMP_MAX_BYTES, idle_ttl=TEMP_IDLE_TTL,
+                 pinned_ttl=TEMP_PINNED_TTL, sweep_interval=TEMP_SWEEP_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.pinned_ttl = pinned_ttl
+        self.sweep_interval = sweep_interval
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._dirs = {} # path -> {'size': bytes, 'accessed': ts, 'pinned': bool}
+        self._thread = None
+        self._load_existing()
+
+    # --- Index ---
+    def _load_existing(self):
+        """Adopts directories left over from a previous run, so they count against the quota."""
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            if entry.is_dir():
+                self._dirs[entry.path] = {'size': self._dir_size(entry.path),
+                                          'accessed': entry.stat().st_mtime, 'pinned': False}
+        if self._dirs:
+            logging.info(f"Temp storage: adopted {len(self._dirs)} directories, {self.total_bytes()} bytes")
+
+    def _dir_size(self, path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def total_bytes(self):
+        return sum(item['size'] for item in self._dirs.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'dirs': len(self._dirs),
+                'pinned': sum(1 for item in self._dirs.values() if item['pinned']),
+                'bytes': self.total_bytes(),
+                'evictions': self.evictions,
+            }
+
+    # --- Request directories ---
+    def create(self):
+        """Creates and tracks a new request directory, pinned until unpin() or release(). Returns its path."""
+        path = os.path.join(self.root, str(uuid.uuid4()))
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._dirs[path] = {'size': 0, 'accessed': time.time(), 'pinned': True}
+        return path
+
+    def refresh(self, path):
+        """Re-measures a directory after files were written to it, then enforces the quota."""
+        if not path:
+            return
+        size = self._dir_size(path)
+        with self._lock:
+            item = self._dirs.get(path)
+            if not item:
+                return
+            item['size'] = size
+            item['accessed'] = time.time()
+            self._evict()
+
+    def touch(self, path):
+        """Marks a directory as recently used."""
+        with self._lock:
+            if path in self._dirs:
+                self._dirs[path]['accessed'] = time.time()
+
+    def pin(self, path):
+        """Protects a directory from eviction (its session is waiting for the user). False if it is gone."""
+        with self._lock:
+            if path not in self._dirs:
+                return False
+            self._dirs[path]['pinned'] = True
+            self._dirs[path]['accessed'] = time.time()
+            return True
+
+    def unpin(self, path):
+        with self._lock:
+            if path in self._dirs:
+                self._dirs[path]['pinned'] = False
+
+    def exists(self, path):
+        """True if the directory is still tracked (it wasn't evicted or released)."""
+        with self._lock:
+            return path in self._dirs
+
+    def release(self, path):
+        """Deletes a directory as soon as its request is done."""
+        if not path:
+            return
+        with self._lock:
+            self._dirs.pop(path, None)
+        shutil.rmtree(path, ignore_errors=True)
+
+    # --- Eviction ---
+    def _remove(self, path, reason):
+        del self._dirs[path]
+        shutil.rmtree(path, ignore_errors=True)
+        logging.info(f"Removed temp dir {path} ({reason})")
+
+    def _evict(self):
+        """Drops least recently used unpinned directories until usage fits in max_bytes."""
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for path in sorted(self._dirs, key=lambda p: self._dirs[p]['accessed']):
+            if total <= self.max_bytes:
+                break
+            # Empty ones free nothing (and may be about to be written to)
+            if self._dirs[path]['pinned'] or not self._dirs[path]['size']:
+                continue
+            total -= self._dirs[path]['size']
+            self._remove(path, "over quota")
+            self.evictions += 1
+        if total > self.max_bytes:
+            logging.warning(f"Temp storage over quota ({total} bytes), everything left is pinned or in use")
+
+    def sweep(self):
+        """Removes abandoned directories and re-measures the rest (downloads may still be writing)."""
+        now = time.time()
+        with self._lock:
+            paths = list(self._dirs)
+        sizes = {path: self._dir_size(path) for path in paths}
+
+        with self._lock:
+            for path, size in sizes.items():
+                item = self._dirs.get(path)
+                if not item:
+                    continue
+                item['size'] = size
+                ttl = self.pinned_ttl if item['pinned'] else self.idle_ttl
+                if now - item['accessed'] > ttl:
+                    self._remove(path, "idle")
+            self._evict()
+
+    def start(self):
+        """Runs sweep() every sweep_interval seconds in a daemon thread."""
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._sweep_loop, daemon=True, name="storage-sweep")
+        self._thread.start()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Error in storage sweep: {e}")
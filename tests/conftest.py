@@ -0,0 +1,20 @@
+import os
+import sys
+import pytest
+
+# The services are top-level modules of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def synthetic_clip(tmp_path_factory):
+    """
+    The benchmark's synthetic clip (720p, 30 fps, 8 seconds, one known sharp frame every 2 seconds).
+    Returns (path, sharp frame indices).
+    """
+    path = str(tmp_path_factory.mktemp('clips') / 'clip.mp4')
+    sharp_frames = benchmark.make_clip(path, 1280, 720, 30, 8, 'mp4v')
+    if sharp_frames is None:
+        pytest.skip("mp4v codec unavailable")
+    return path, sharp_frames
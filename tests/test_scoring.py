@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import pytest
+from scoring_service import SharpnessScorer
+from video_service import VideoService
+
+
+@pytest.fixture(scope='module')
+def clip(synthetic_clip):
+    """Decoded frames of the synthetic clip, and its known sharp frames."""
+    path, sharp_frames = synthetic_clip
+    cap = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        success, frame = cap.read()
+        if not success:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames, sharp_frames
+
+
+@pytest.fixture(scope='module')
+def reference_scores(clip):
+    frames, _ = clip
+    service = VideoService()
+    return np.array([service.get_blur_score(frame) for frame in frames])
+
+
+@pytest.fixture(scope='module', params=[0, 360], ids=['full', 'downscaled'])
+def scores(request, clip):
+    """SharpnessScorer scores of the clip, at full resolution and at the default working height."""
+    frames, _ = clip
+    scorer = SharpnessScorer(request.param)
+    return [scorer.score(frame) for frame in frames]
+
+
+def top(scores, k):
+    return set(np.argsort(-np.asarray(scores), kind='stable')[:k].tolist())
+
+
+def test_sharp_frames_rank_first(clip, reference_scores, scores):
+    _, sharp_frames = clip
+    assert top(scores, len(sharp_frames)) == set(sharp_frames) == top(reference_scores, len(sharp_frames))
+
+
+@pytest.mark.parametrize('k', [10, 20, 50])
+def test_top_k_overlaps_reference(reference_scores, scores, k):
+    assert len(top(scores, k) & top(reference_scores, k)) >= 0.8 * k
+
+
+def test_signature_tracks_similarity(clip):
+    frames, _ = clip
+    scorer = SharpnessScorer()
+    scorer.score(frames[0])
+    first = scorer.signature()
+    scorer.score(frames[0])
+    assert scorer.signature() == first
+    scorer.score(cv2.flip(frames[0], 1))
+    assert scorer.signature() != first
@@ -0,0 +1,28 @@
+import pytest
+from video_service import VideoService
+
+
+@pytest.fixture(scope='module')
+def clip(synthetic_clip):
+    return synthetic_clip[0]
+
+
+@pytest.mark.parametrize('workers', [2, 3, 4])
+def test_segmented_matches_single_pass(clip, workers):
+    service = VideoService()
+    single = service.analyze_video_result(clip, strategy="exhaustive")
+
+    plan = service.plan_segments(clip, workers, min_segment_seconds=1)
+    assert len(plan['segments']) == workers
+    parts = [service.analyze_segment(clip, start, end, plan['min_distance']) for start, end in plan['segments']]
+    merged = service.merge_segments(plan, parts)
+
+    assert merged['candidates'] == single['candidates']
+    assert merged['scene_cuts'] == single['scene_cuts']
+    assert merged['stats']['frames_decoded'] == single['stats']['frames_decoded']
+    assert set(merged['frames']) == set(single['frames'])
+
+
+def test_short_clip_is_not_split(clip):
+    plan = VideoService().plan_segments(clip, 4, min_segment_seconds=60)
+    assert plan['segments'] == [(0, None)]
@@ -0,0 +1,83 @@
+import random
+from bisect import bisect_right
+import pytest
+from video_service import SceneTracker, TopScores, VideoService
+
+
+def reference_select(scored_frames, min_distance, scene_cuts=()):
+    """The original greedy selection: every frame kept, each one checked against every pick."""
+    selected = []
+    for frame_idx, score in sorted(scored_frames, key=lambda x: (-x[1], x[0])):
+        if any(abs(frame_idx - idx) < min_distance
+               and bisect_right(scene_cuts, frame_idx) == bisect_right(scene_cuts, idx)
+               for idx, _ in selected):
+            continue
+        selected.append((frame_idx, score))
+    return selected
+
+
+def random_scores(rng, ties=False):
+    count = rng.randint(1, 3000)
+    if ties:
+        return [(idx, float(rng.randint(0, 20))) for idx in range(count)]
+    return [(idx, rng.random() * 1000) for idx in range(count)]
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('ties', [False, True])
+def test_bisect_selection_matches_reference(seed, ties):
+    rng = random.Random(seed)
+    scored = random_scores(rng, ties)
+    min_distance = rng.randint(1, 30)
+    cuts = sorted(rng.sample(range(len(scored)), min(len(scored), rng.randint(0, 5))))
+
+    assert VideoService().select_candidates(scored, min_distance) == reference_select(scored, min_distance)
+    assert (VideoService().select_candidates(scored, min_distance, scene_cuts=cuts)
+            == reference_select(scored, min_distance, cuts))
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('ties', [False, True])
+def test_bounded_heap_keeps_the_first_candidates(seed, ties):
+    rng = random.Random(seed)
+    scored = random_scores(rng, ties)
+    min_distance = rng.randint(1, 30)
+    max_candidates = rng.randint(1, 20)
+    cuts = sorted(rng.sample(range(len(scored)), min(len(scored), rng.randint(0, 5))))
+
+    top_scores = TopScores(max_candidates, min_distance)
+    for frame_idx, score in rng.sample(scored, len(scored)):
+        top_scores.push(frame_idx, score)
+    assert len(top_scores) <= top_scores.size
+
+    selected = VideoService().select_candidates(top_scores.items(), min_distance, limit=max_candidates,
+                                                scene_cuts=cuts)
+    assert selected == reference_select(scored, min_distance, cuts)[:max_candidates]
+
+
+def test_seed_is_kept_first():
+    scored = [(idx, float(idx % 7)) for idx in range(100)]
+    seed = [(50, 1.0), (3, 3.0)]
+    selected = VideoService().select_candidates(scored, 10, seed=seed)
+    assert selected[:2] == seed
+    assert all(abs(idx - 50) >= 10 and abs(idx - 3) >= 10 for idx, _ in selected[2:])
+
+
+def test_peak_windows_reach_the_neighbouring_samples():
+    service = VideoService()
+    # Samples every 6 frames: each window is the old +-(step - 1) range around the peak
+    scores = {idx: 1.0 for idx in range(0, 60, 6)}
+    scores[30] = 5.0
+    assert service._peak_windows(scores, 60, step=6, peaks=1) == [[25, 35]]
+    # Sparse (keyframe) samples: fewer peaks fit in the same frame budget, windows are merged
+    scores = {0: 1.0, 50: 4.0, 100: 3.0, 150: 2.0}
+    assert service._peak_windows(scores, 200, step=6, peaks=10) == [[1, 149]]
+
+
+def test_scene_cuts_need_neighbouring_frames():
+    far = (1 << 64) - 1
+    # Samples 6 frames apart: the jump may just be motion
+    assert SceneTracker.from_signatures({0: 0, 6: far, 12: 0}).cuts == []
+    # Once the frames in between are scored, the cut is placed exactly
+    signatures = {idx: 0 if idx < 9 else far for idx in range(13)}
+    assert SceneTracker.from_signatures(signatures).cuts == [9]
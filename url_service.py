@@ -0,0 +1,52 @@
+import logging
+import re
+from urllib.parse import urlparse
+
+# Pure functions of a link: handlers call them on the event loop, before (and without) the
+# Instagram service, so they must not import instaloader / yt-dlp or touch the network
+
+
+def get_shortcode_from_url(url):
+    # Handle Post/Reel/TV
+    match = re.search(r'instagram\.com\/(?:p|reel|tv)\/([A-Za-z0-9_-]+)', url)
+    if match:
+        return ('post', match.group(1))
+
+    # Handle Stories
+    # https://instagram.com/stories/username/123456789/
+    match_story = re.search(r'instagram\.com\/stories\/([^\/]+)\/([0-9]+)', url)
+    if match_story:
+        return ('story', (match_story.group(1), match_story.group(2)))
+
+    logging.error(f"Could not parse content from URL: {url}")
+    return None
+
+def get_media_key(url, content_info=None, playlist_index=None):
+    """
+    Returns a stable key for the media behind a link (post shortcode or story media ID), or None.
+    Posts/Reels are keyed from the URL alone (no network). Story links can resolve to a whole
+    story feed, so they need the check_download_type result (and the chosen 1-based playlist_index).
+    """
+    if content_info:
+        info = content_info.get('info') or {}
+        if content_info.get('type') == 'playlist':
+            entries = info.get('entries') or []
+            if playlist_index and 0 < playlist_index <= len(entries):
+                return entries[playlist_index - 1].get('id')
+            return None
+        if content_info.get('type') == 'video':
+            return info.get('id')
+        return None
+
+    parsing_result = get_shortcode_from_url(url)
+    if parsing_result and parsing_result[0] == 'post':
+        return parsing_result[1]
+    return None
+
+def normalize_url(url):
+    """Drops tracking query strings / fragments so the same media always maps to the same key."""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return f"https://{host}{parsed.path.rstrip('/')}/"
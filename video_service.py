@@ -1,12 +1,273 @@
 import cv2
 import os
+import re
+import heapq
+import logging
+import subprocess
+import time
 import numpy as np
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from config import ANALYSIS_STRATEGY, SAMPLE_STEP, REFINE_PEAKS, FRAME_CACHE_SIZE, FRAME_EXTRACTION, MAX_CANDIDATES
+from config import FFMPEG_BIN, STREAM_FIRST_PAGE_SECONDS
+from config import PREVIEW_JPEG_QUALITY, DOCUMENT_JPEG_QUALITY, DOCUMENT_FORMAT, INDEX_THUMBNAILS
+from config import MIN_DISTANCE_SECONDS, DUPLICATE_DISTANCE, SCENE_CUT_DISTANCE, REFINE_CHUNK_FRAMES, SEGMENT_MIN_SECONDS
+from scoring_service import SharpnessScorer, signature_distance
+from index_service import FrameIndex
+
+MIN_SCORE = 10.0 # Anything below is completely black/blank
+
+def encode_frame(frame, fmt=DOCUMENT_FORMAT, quality=DOCUMENT_JPEG_QUALITY):
+    """
+    Encodes a frame in memory. fmt: "jpg", "webp" or "png" (lossless, quality is ignored).
+    Returns bytes, or None if encoding failed.
+    """
+    if fmt == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    elif fmt == "webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        fmt, params = "jpg", [cv2.IMWRITE_JPEG_QUALITY, quality]
+    success, buffer = cv2.imencode(f'.{fmt}', frame, params)
+    return buffer.tobytes() if success else None
+
+class TopScores:
+    """
+    Bounded min-heap of the best (score, frame_idx, signature) entries seen while decoding.
+    Greedy diversity selection of K candidates only ever looks at the best K * (2 * min_distance - 1)
+    frames (each pick blocks at most 2 * (min_distance - 1) others), so keeping that many gives
+    exactly the same first K candidates as keeping every frame, with memory independent of clip length.
+    (Near-duplicate suppression can reject more than that, so with it the bound is a close approximation.)
+    Entries are ordered like the selection (equal scores: the later frame is worse), so ties at the
+    bound drop the frame selection would have taken last.
+    """
+    def __init__(self, max_candidates=MAX_CANDIDATES, min_distance=15):
+        self.size = max_candidates * (2 * max(1, min_distance) - 1) if max_candidates else 0
+        self._heap = [] # (score, -frame_idx, signature): the root is the worst kept frame
+
+    def push(self, frame_idx, score, signature=None):
+        entry = (score, -frame_idx, signature)
+        if not self.size or len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """Returns [(frame_idx, score)] in no particular order."""
+        return [(-neg_idx, score) for score, neg_idx, _ in self._heap]
+
+    def entries(self):
+        """Returns [(score, frame_idx, signature)] entries, e.g. to merge them into another TopScores."""
+        return [(score, -neg_idx, signature) for score, neg_idx, signature in self._heap]
+
+    def signatures(self):
+        """Returns {frame_idx: signature} of the kept frames."""
+        return {-neg_idx: signature for _, neg_idx, signature in self._heap if signature is not None}
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class TopFrameCache:
+    """
+    Keeps JPEG copies of the best, mutually distant frames seen during analysis,
+    so the first pages can be served later without decoding the video again.
+    A run of neighbouring frames only costs one encode: the best frame of the run
+    is held raw and encoded once the run is over.
+    """
+    def __init__(self, size, min_distance):
+        self.size = size
+        self.min_distance = min_distance
+        self.frames = {} # frame_idx -> (score, jpeg bytes)
+        self._pending = None # (frame_idx, score, frame)
+
+    def offer(self, frame_idx, score, frame):
+        if self.size <= 0:
+            return
+        if self._pending and abs(frame_idx - self._pending[0]) < self.min_distance:
+            if score > self._pending[1]:
+                self._pending = (frame_idx, score, frame)
+            return
+        self.flush()
+        self._pending = (frame_idx, score, frame)
+
+    def flush(self):
+        if not self._pending:
+            return
+        frame_idx, score, frame = self._pending
+        self._pending = None
+
+        # Served as page previews: same quality as the ones render_frames encodes
+        self._insert(frame_idx, score, lambda: encode_frame(frame, "jpg", PREVIEW_JPEG_QUALITY))
+
+    def add_encoded(self, frame_idx, score, data):
+        """Adds an already encoded frame (e.g. from another segment's cache) under the same rules."""
+        if self.size > 0:
+            self._insert(frame_idx, score, lambda: data)
+
+    def _insert(self, frame_idx, score, encode):
+        # Not good enough to enter a full cache
+        if len(self.frames) >= self.size and score <= min(s for s, _ in self.frames.values()):
+            return
+
+        # A better frame already covers this moment
+        neighbours = [idx for idx in self.frames if abs(idx - frame_idx) < self.min_distance]
+        if any(self.frames[idx][0] >= score for idx in neighbours):
+            return
+
+        data = encode()
+        if data is None:
+            return
+        for idx in neighbours:
+            del self.frames[idx]
+        self.frames[frame_idx] = (score, data)
+
+        if len(self.frames) > self.size:
+            worst = min(self.frames, key=lambda idx: self.frames[idx][0])
+            del self.frames[worst]
+
+    def to_dict(self):
+        """Returns {frame_idx: jpeg bytes}."""
+        self.flush()
+        return {idx: data for idx, (_, data) in self.frames.items()}
+
+class SceneTracker:
+    """
+    Finds scene cuts from the signatures of frames observed in order:
+    a jump of more than `threshold` bits between two neighbouring frames starts a new scene.
+    Frames further apart (sampled passes) are not compared, since motion alone moves their
+    signatures that far; such cuts are found once the frames in between are scored.
+    """
+    def __init__(self, threshold=SCENE_CUT_DISTANCE):
+        self.threshold = threshold
+        self.cuts = [] # First frame index of every scene after the first one
+        self.first = None # Signatures of the first / last observed frame
+        self.last = None
+        self.last_idx = None
+
+    @classmethod
+    def from_signatures(cls, signatures, threshold=SCENE_CUT_DISTANCE):
+        """Tracker over {frame_idx: signature} of a (partly) sampled pass."""
+        scenes = cls(threshold)
+        for frame_idx in sorted(signatures):
+            scenes.observe(frame_idx, signatures[frame_idx])
+        return scenes
+
+    def observe(self, frame_idx, signature):
+        if self.last is None:
+            self.first = signature
+        elif frame_idx == self.last_idx + 1 and self.is_cut(self.last, signature):
+            self.cuts.append(frame_idx)
+        self.last = signature
+        self.last_idx = frame_idx
+
+    def is_cut(self, before, after):
+        return signature_distance(before, after) > self.threshold
+
+
+class SignatureIndex:
+    """
+    Near-duplicate lookup over the signatures of already chosen frames.
+    Signatures are split into 8 bytes: two signatures less than 8 bits apart share at least one
+    byte exactly, so only frames sharing a byte with the query are compared.
+    """
+    def __init__(self, threshold=DUPLICATE_DISTANCE):
+        self.threshold = threshold
+        self._buckets = {} # (byte position, byte value) -> [signature]
+        self._all = []
+
+    @staticmethod
+    def _keys(signature):
+        return [(i, (signature >> (8 * i)) & 0xFF) for i in range(8)]
+
+    def add(self, signature):
+        self._all.append(signature)
+        for key in self._keys(signature):
+            self._buckets.setdefault(key, []).append(signature)
+
+    def has_duplicate(self, signature):
+        if self.threshold < 0:
+            return False
+        if self.threshold >= 8:
+            others = self._all
+        else:
+            others = (other for key in self._keys(signature) for other in self._buckets.get(key, ()))
+        return any(signature_distance(signature, other) <= self.threshold for other in others)
+
+
+class StreamAnalyzer:
+    """
+    Scores frames one by one as they arrive (e.g. from a decoder that is still downloading).
+    Streams are analyzed in IO threads, several at once: each analyzer has its own scorer, since
+    a SharpnessScorer's buffers, last signature and timing belong to the frames it just scored.
+    """
+    def __init__(self, service, min_distance=15, cache_size=FRAME_CACHE_SIZE):
+        self.service = service
+        self.scorer = SharpnessScorer(service.scorer.work_height)
+        self.min_distance = min_distance
+        self.frame_cache = TopFrameCache(cache_size, min_distance)
+        self.top_scores = TopScores(MAX_CANDIDATES, min_distance)
+        self.scenes = SceneTracker()
+        self.frame_count = 0
+        self._started = time.perf_counter()
+        self._scored_before = self.scorer.seconds
+
+    def add(self, frame):
+        score = self.scorer.score(frame)
+        signature = self.scorer.signature()
+        self.scenes.observe(self.frame_count, signature)
+        if score > MIN_SCORE:
+            self.top_scores.push(self.frame_count, score, signature)
+            self.frame_cache.offer(self.frame_count, score, frame)
+        self.frame_count += 1
+
+    def result(self, cached_only=False):
+        """
+        Current ranking, same shape as analyze_video_result.
+        cached_only: only return candidates whose JPEG is already in memory (servable without the video file).
+        """
+        frames = self.frame_cache.to_dict()
+        stats = {'frames_total': self.frame_count, 'frames_decoded': self.frame_count,
+                 'frames_retrieved': self.frame_count, 'frames_scored': self.frame_count}
+        # "Decode" includes waiting for the download here
+        stats.update(self.service._timing(self._started, self._scored_before, self.scorer))
+        return self.service._build_result(self.top_scores, self.scenes, self.min_distance, frames, stats,
+                                          cached_only=cached_only)
+
+
+class AnalysisState:
+    """
+    Resumable scoring state of one request (progressive mode): the coarse pass, then refinement
+    steps that each continue from `position`. Plain data, so it can travel to a CPU worker and back.
+    """
+    def __init__(self, video_path, min_distance, frame_cache):
+        self.video_path = video_path
+        self.min_distance = min_distance
+        self.frame_cache = frame_cache
+        self.scores = {} # frame_idx -> score of every frame scored so far
+        self.signatures = {} # frame_idx -> signature
+        self.scenes = SceneTracker()
+        self.frame_total = 0
+        self.position = 0 # Next frame the refinement looks at
+        self.decoded = 0 # Frames the decoder went through (read or only grabbed)
+        self.retrieved = 0 # Frames converted to images
+        self.timing = {} # decode / score seconds of the last step
+
+    @property
+    def done(self):
+        return self.position >= self.frame_total
+
 
 class VideoService:
+    def __init__(self, scorer=None):
+        # Downscaled, buffer-reusing scorer used by analyze_video
+        self.scorer = scorer or SharpnessScorer()
+
     def get_blur_score(self, image):
         """
         Calculates sharpness score using Laplacian Variance.
         Implements center-weighting to favor subject focus.
+        Full-resolution reference implementation; analyze_video uses self.scorer.
         """
         if image is None: 
             return 0.0
@@ -41,90 +302,762 @@ class VideoService:
         
         return final_score
 
-    def analyze_video(self, video_path, min_distance=15):
+    def analyze_video(self, video_path, min_distance=None, strategy=None):
         """
         Analyzes the video and returns a list of candidate frames sorted by sharpness score.
+        min_distance: minimum frames between candidates of the same scene (None = MIN_DISTANCE_SECONDS at the clip's fps).
+        strategy: "exhaustive" scores every frame, "sampled" scores every Nth frame
+        and then densely re-scores the windows around the best peaks.
         Returns: list of (frame_index, score)
         """
+        return self.analyze_video_result(video_path, min_distance, strategy, cache_size=0)['candidates']
+
+    def analyze_video_result(self, video_path, min_distance=None, strategy=None, cache_size=FRAME_CACHE_SIZE):
+        """
+        Same as analyze_video, but also returns JPEG copies of the best frames and decode stats.
+        Returns: {'candidates': [(frame_index, score)], 'frames': {frame_index: jpeg bytes}, 'stats': {...},
+                  'signatures': {frame_index: int}, 'scene_cuts': [frame_index], 'min_distance': frames}
+        """
+        strategy = strategy or ANALYSIS_STRATEGY
+
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
+            return {'candidates': [], 'frames': {}, 'stats': {}, 'signatures': {}, 'scene_cuts': [], 'min_distance': 1}
+
+        if min_distance is None:
+            min_distance = self.distance_in_frames(cap.get(cv2.CAP_PROP_FPS))
+        frame_cache = TopFrameCache(cache_size, min_distance)
+        top_scores = TopScores(MAX_CANDIDATES, min_distance)
+        scenes = SceneTracker()
+
+        started, scored_before = time.perf_counter(), self.scorer.seconds
+        if strategy == "sampled":
+            stats = self._score_sampled(video_path, cap, SAMPLE_STEP, REFINE_PEAKS, frame_cache, top_scores, scenes)
+        else:
+            stats = self._score_exhaustive(cap, frame_cache, top_scores, scenes)
+        
+        cap.release()
+        stats.update(self._timing(started, scored_before))
+
+        stats['strategy'] = strategy
+        self.last_stats = stats
+        logging.info(f"Analyzed {video_path}: {stats}")
+
+        return self._build_result(top_scores, scenes, min_distance, frame_cache.to_dict(), stats)
+
+    def start_analysis(self, video_path, min_distance=None, step=None, cache_size=FRAME_CACHE_SIZE):
+        """
+        Fast first pass for progressive delivery: only every `step`-th frame is scored.
+        Returns (state, result); hand the state to resume_analysis to score the remaining frames.
+        state is None if the video can't be opened.
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            return None, {'candidates': [], 'frames': {}, 'stats': {}, 'signatures': {}, 'scene_cuts': [], 'min_distance': 1}
+
+        if min_distance is None:
+            min_distance = self.distance_in_frames(cap.get(cv2.CAP_PROP_FPS))
+        state = AnalysisState(video_path, min_distance, TopFrameCache(cache_size, min_distance))
+        started, scored_before = time.perf_counter(), self.scorer.seconds
+        stats, _ = self._coarse_pass(video_path, cap, max(1, step or SAMPLE_STEP), state.scores, state.signatures,
+                                     state.frame_cache)
+        state.frame_total, state.decoded, state.retrieved = (stats['frames_total'], stats['frames_decoded'],
+                                                             stats['frames_retrieved'])
+        cap.release()
+        state.frame_cache.flush()
+        state.timing = self._timing(started, scored_before)
+
+        result = self.analysis_result(state)
+        logging.info(f"Coarse pass of {video_path}: {result['stats']}")
+        return state, result
+
+    def resume_analysis(self, state, max_frames=REFINE_CHUNK_FRAMES):
+        """
+        Scores up to max_frames more frames (the ones earlier passes skipped), continuing where the
+        previous call stopped. Returns (state, result); state.done once every frame is scored.
+        """
+        cap = cv2.VideoCapture(state.video_path)
+        if not cap.isOpened():
+            raise IOError(f"Could not open {state.video_path}")
+        if state.position:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, state.position)
+
+        end = min(state.frame_total, state.position + max_frames) if max_frames else state.frame_total
+        idx = state.position
+        started, scored_before = time.perf_counter(), self.scorer.seconds
+        decoded_before, retrieved_before, scored_before_count = state.decoded, state.retrieved, len(state.scores)
+        while idx < end:
+            if idx in state.scores:
+                # Scored in the coarse pass, just step over it (still decoded)
+                if not cap.grab():
+                    break
+                state.decoded += 1
+            else:
+                success, frame = cap.read()
+                if not success:
+                    break
+                state.decoded += 1
+                state.retrieved += 1
+                state.scores[idx] = self.scorer.score(frame)
+                state.signatures[idx] = self.scorer.signature()
+                state.frame_cache.offer(idx, state.scores[idx], frame)
+            idx += 1
+        cap.release()
+        state.frame_cache.flush()
+        state.timing = dict(self._timing(started, scored_before), frames_decoded=state.decoded - decoded_before,
+                            frames_retrieved=state.retrieved - retrieved_before,
+                            frames_scored=len(state.scores) - scored_before_count)
+
+        # A short read means the container reported more frames than it has: nothing left to score
+        state.position = idx if idx == end else state.frame_total
+        # Every frame before position is scored now, so cuts there are found between neighbours
+        state.scenes = SceneTracker.from_signatures(state.signatures)
+        return state, self.analysis_result(state)
+
+    def analysis_result(self, state):
+        """Current ranking of a progressive analysis, same shape as analyze_video_result."""
+        top_scores = TopScores(MAX_CANDIDATES, state.min_distance)
+        for idx, score in state.scores.items():
+            if score > MIN_SCORE:
+                top_scores.push(idx, score, state.signatures[idx])
+        stats = {
+            'frames_total': state.frame_total, 'frames_decoded': state.decoded, 'frames_retrieved': state.retrieved,
+            'frames_scored': len(state.scores),
+            'strategy': 'progressive', 'refined': state.done,
+        }
+        # Timing (and, after a refinement step, frames decoded / retrieved / scored) of the last step only, so the
+        # stats of successive steps add up to the whole analysis
+        stats.update(state.timing)
+        return self._build_result(top_scores, state.scenes, state.min_distance, state.frame_cache.to_dict(), stats)
+
+    def plan_segments(self, video_path, workers, min_segment_seconds=SEGMENT_MIN_SECONDS):
+        """
+        Splits a video into at most `workers` segments for analyze_segment, with every boundary
+        moved to the nearest keyframe so no worker decodes frames that belong to another segment.
+        Returns {'segments': [(start, end)], 'min_distance': frames, 'keyframe_aligned': bool}
+        (the last end is None: read to the end), or None if the video can't be opened.
+        """
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            return None
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        min_distance = self.distance_in_frames(fps)
+        fps = fps if 0 < fps <= 1000 else 30
+        count = min(workers, int(frame_total // max(1, min_segment_seconds * fps)))
+        if count < 2:
+            return {'segments': [(0, None)], 'min_distance': min_distance, 'keyframe_aligned': False}
+
+        keyframes = self.keyframe_indices(video_path, fps)
+        bounds = []
+        for i in range(1, count):
+            target = frame_total * i // count
+            if keyframes:
+                pos = bisect_left(keyframes, target)
+                target = min(keyframes[max(0, pos - 1):pos + 1], key=lambda k: abs(k - target))
+            if 0 < target < frame_total and (not bounds or target > bounds[-1]):
+                bounds.append(target)
+
+        segments = list(zip([0] + bounds, bounds + [None]))
+        return {'segments': segments, 'min_distance': min_distance, 'keyframe_aligned': bool(keyframes)}
+
+    def keyframe_indices(self, video_path, fps):
+        """
+        Frame indices of the video's keyframes, from ffmpeg decoding keyframes only.
+        Returns [] if ffmpeg isn't available (segments are then split evenly).
+        """
+        cmd = [FFMPEG_BIN, '-hide_banner', '-nostdin', '-skip_frame', 'nokey', '-i', video_path,
+               '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-']
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.warning(f"Could not read keyframes of {video_path}: {e}")
             return []
 
-        all_scored_frames = []
-        frame_count = 0
+        times = [float(t) for t in re.findall(rb'pts_time:(-?[0-9.]+)', proc.stderr)]
+        if proc.returncode != 0 or not times:
+            return []
+        origin = min(times)
+        return sorted({int(round((t - origin) * fps)) for t in times})
+
+    def analyze_segment(self, video_path, start, end, min_distance, cache_size=FRAME_CACHE_SIZE):
+        """
+        Scores frames [start, end) of a video (end None = to the end) with its own VideoCapture.
+        Meant to run in a worker process; the parts are combined with merge_segments.
+        """
+        frame_cache = TopFrameCache(cache_size, min_distance)
+        top_scores = TopScores(MAX_CANDIDATES, min_distance)
+        scenes = SceneTracker()
+
+        cap = cv2.VideoCapture(video_path)
+        if not cap.isOpened():
+            raise IOError(f"Could not open {video_path}")
+        if start:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        started, scored_before = time.perf_counter(), self.scorer.seconds
+        stats = self._score_exhaustive(cap, frame_cache, top_scores, scenes, start, end)
+        cap.release()
+        frame_cache.flush()
+        stats.update(self._timing(started, scored_before))
+
+        return {
+            'start': start,
+            'entries': top_scores.entries(),
+            'frames': frame_cache.frames,
+            'cuts': scenes.cuts,
+            'first_signature': scenes.first,
+            'last_signature': scenes.last,
+            'stats': stats,
+        }
+
+    def merge_segments(self, plan, parts, cache_size=FRAME_CACHE_SIZE):
+        """
+        Combines analyze_segment results (in segment order) into one analyze_video_result.
+        Every segment kept its own best K * (2 * min_distance - 1) frames, so selecting over the
+        merged scores applies min_distance across segment boundaries exactly as a single pass would.
+        """
+        min_distance = plan['min_distance']
+        top_scores = TopScores(MAX_CANDIDATES, min_distance)
+        frame_cache = TopFrameCache(cache_size, min_distance)
+        scenes = SceneTracker()
+        # Seconds are summed over the workers (CPU time, not wall time)
+        stats = {'frames_total': 0, 'frames_decoded': 0, 'frames_retrieved': 0, 'frames_scored': 0,
+                 'decode_seconds': 0.0, 'score_seconds': 0.0}
+
+        previous = None
+        for part in parts:
+            for score, frame_idx, signature in part['entries']:
+                top_scores.push(frame_idx, score, signature)
+            for frame_idx, (score, data) in part['frames'].items():
+                frame_cache.add_encoded(frame_idx, score, data)
+
+            # A cut can fall exactly on a segment boundary
+            if (previous and previous['last_signature'] is not None and part['first_signature'] is not None
+                    and scenes.is_cut(previous['last_signature'], part['first_signature'])):
+                scenes.cuts.append(part['start'])
+            scenes.cuts.extend(part['cuts'])
+
+            for key in stats:
+                stats[key] += part['stats'][key]
+            previous = part
+
+        stats['strategy'] = 'segmented'
+        stats['segments'] = len(parts)
+        self.last_stats = stats
+        logging.info(f"Merged {len(parts)} segments: {stats}")
+        return self._build_result(top_scores, scenes, min_distance, frame_cache.to_dict(), stats)
+
+    def _timing(self, started, scored_before, scorer=None):
+        """Splits a pass's time into scoring (inside the scorer) and decoding (everything else: reading / caching frames)."""
+        score_seconds = (scorer or self.scorer).seconds - scored_before
+        return {'decode_seconds': time.perf_counter() - started - score_seconds, 'score_seconds': score_seconds}
 
-        while True:
+    def distance_in_frames(self, fps, seconds=MIN_DISTANCE_SECONDS):
+        """Converts a time distance to frames at the given fps (falls back to 30 fps when unknown)."""
+        if not fps or fps <= 0 or fps > 1000:
+            fps = 30
+        return max(1, int(round(seconds * fps)))
+
+    def _build_result(self, top_scores, scenes, min_distance, frames, stats, cached_only=False):
+        """Runs the final selection over a finished (or partial) scoring pass."""
+        signatures = top_scores.signatures()
+        candidates = self.select_candidates(top_scores.items(), min_distance, limit=MAX_CANDIDATES or None,
+                                            signatures=signatures, scene_cuts=scenes.cuts)
+        if cached_only:
+            candidates = [c for c in candidates if c[0] in frames]
+        stats['scene_cuts'] = len(scenes.cuts)
+        return {
+            'candidates': candidates,
+            'frames': frames,
+            'stats': stats,
+            'signatures': {frame_idx: signatures[frame_idx] for frame_idx, _ in candidates if frame_idx in signatures},
+            'scene_cuts': list(scenes.cuts),
+            'min_distance': min_distance,
+        }
+
+    def analyze_stream(self, media_info, output_path, min_distance=None, on_partial=None,
+                       partial_after_seconds=STREAM_FIRST_PAGE_SECONDS, cancel_event=None):
+        """
+        Scores a remote video while it downloads.
+        One ffmpeg process reads the media URL, copies the stream to output_path (for later pages)
+        and pipes raw BGR frames to the scorer as they are decoded.
+        media_info: {'url', 'http_headers', 'width', 'height', 'fps'} from InstagramService.get_stream_info
+        on_partial(result): called once, from this thread, after partial_after_seconds of video
+        with a ranking that only uses in-memory frames.
+        Returns the same dict as analyze_video_result, or None if streaming failed.
+        """
+        width, height = media_info['width'], media_info['height']
+        fps = media_info.get('fps') or 30
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (media_info.get('http_headers') or {}).items())
+
+        cmd = [FFMPEG_BIN, '-loglevel', 'error', '-nostdin']
+        if headers:
+            cmd += ['-headers', headers]
+        cmd += [
+            '-i', media_info['url'],
+            '-map', '0:v:0', '-c', 'copy', '-y', output_path,
+            '-map', '0:v:0', '-vf', f'scale={width}:{height}', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1',
+        ]
+
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logging.error(f"Could not start ffmpeg: {e}")
+            return None
+
+        analyzer = StreamAnalyzer(self, min_distance or self.distance_in_frames(fps))
+        frame_size = width * height * 3
+        partial_at = int(partial_after_seconds * fps)
+
+        finished = False
+        try:
+            while True:
+                if cancel_event and cancel_event.is_set():
+                    logging.info("Stream analysis cancelled")
+                    return None
+
+                frame = np.empty((height, width, 3), dtype=np.uint8)
+                if proc.stdout.readinto(memoryview(frame).cast('B')) != frame_size:
+                    finished = True
+                    break
+                analyzer.add(frame)
+
+                if on_partial and analyzer.frame_count == partial_at:
+                    on_partial(analyzer.result(cached_only=True))
+        finally:
+            if not finished:
+                proc.kill()
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode(errors='ignore')
+            proc.wait()
+
+        if proc.returncode != 0 or analyzer.frame_count == 0:
+            logging.error(f"ffmpeg stream failed ({proc.returncode}): {stderr.strip()}")
+            return None
+
+        result = analyzer.result()
+        result['stats']['strategy'] = 'stream'
+        self.last_stats = result['stats']
+        logging.info(f"Analyzed stream into {output_path}: {result['stats']}")
+        return result
+
+    def select_candidates(self, scored_frames, min_distance=15, seed=(), limit=None, signatures=None, scene_cuts=()):
+        """
+        Picks diverse candidates from (frame_index, score) tuples, best first.
+        seed: candidates that are already chosen (e.g. already shown to the user); they are
+        kept first, in order, and nothing closer than min_distance to them is added.
+        limit: stop after this many candidates (None = all).
+        signatures: optional {frame_index: signature}; frames that look like an already chosen
+        frame (within DUPLICATE_DISTANCE bits) are skipped, however far apart they are.
+        scene_cuts: sorted frame indices where a new scene starts; min_distance only applies within a scene.
+        """
+        return list(islice(self.iter_candidates(scored_frames, min_distance, seed, signatures, scene_cuts), limit))
+
+    def iter_candidates(self, scored_frames, min_distance=15, seed=(), signatures=None, scene_cuts=()):
+        """
+        Lazily yields diverse candidates, best first (see select_candidates).
+        Chosen frame indices are kept in a sorted array, so the distance check is a bisect
+        against the two nearest picks instead of a scan over all of them.
+        """
+        signatures = signatures or {}
+        duplicates = SignatureIndex()
+        selected = sorted(frame_idx for frame_idx, _ in seed)
+        for frame_idx, _ in seed:
+            if frame_idx in signatures:
+                duplicates.add(signatures[frame_idx])
+        for candidate in seed:
+            yield candidate
+
+        def same_scene(a, b):
+            return bisect_right(scene_cuts, a) == bisect_right(scene_cuts, b)
+
+        # Sort by score descending to find best frames (ties: earlier frame first)
+        for frame_idx, score in sorted(scored_frames, key=lambda x: (-x[1], x[0])):
+            # Check distance against the nearest ALREADY selected frames on both sides.
+            # Scenes are contiguous, so if the nearest pick is past a cut, every farther one is too.
+            pos = bisect_left(selected, frame_idx)
+            if pos > 0 and frame_idx - selected[pos - 1] < min_distance and same_scene(selected[pos - 1], frame_idx):
+                continue
+            if pos < len(selected) and selected[pos] - frame_idx < min_distance and same_scene(selected[pos], frame_idx):
+                continue
+
+            signature = signatures.get(frame_idx)
+            if signature is not None:
+                if duplicates.has_duplicate(signature):
+                    continue
+                duplicates.add(signature)
+            
+            selected.insert(pos, frame_idx)
+            # Candidates come out sorted by score (best first).
+            # For pagination, we grab Top N best, then Sort those N by time.
+            yield (frame_idx, score)
+
+    def _score_exhaustive(self, cap, frame_cache, top_scores, scenes, start=0, end=None):
+        """
+        Decodes and scores every frame into top_scores, tracking scene cuts. Returns stats.
+        start / end: frame range the capture is positioned at (end None = until the stream ends).
+        """
+        frame_count = start
+
+        while end is None or frame_count < end:
             success, frame = cap.read()
             if not success:
                 break
             
-            score = self.get_blur_score(frame)
+            score = self.scorer.score(frame)
+            signature = self.scorer.signature()
+            scenes.observe(frame_count, signature)
             
-            # Keep everything that isn't completely black/blank (threshold > 10)
-            if score > 10.0:
-                all_scored_frames.append((frame_count, score))
+            # Keep everything that isn't completely black/blank
+            if score > MIN_SCORE:
+                top_scores.push(frame_count, score, signature)
+                frame_cache.offer(frame_count, score, frame)
             
             frame_count += 1
-        
-        cap.release()
 
-        # Sort by score descending to find best frames
-        all_scored_frames.sort(key=lambda x: x[1], reverse=True)
-        
-        # Filter for diversity (time distance)
-        final_candidates = []
-        
-        for frame_idx, score in all_scored_frames:
-            # Check distance against ALREADY selected high-score frames
-            too_close = False
-            for existing_idx, _ in final_candidates:
-                if abs(frame_idx - existing_idx) < min_distance:
-                    too_close = True
+        scored = frame_count - start
+        stats = {'frames_total': scored, 'frames_decoded': scored, 'frames_retrieved': scored, 'frames_scored': scored}
+        return stats
+
+    def _score_sampled(self, video_path, cap, step, peaks, frame_cache, top_scores, scenes):
+        """
+        Coarse-to-fine scoring.
+        1. Coarse pass: score a sparse sample of the stream (keyframes, or every `step`-th frame; see _coarse_pass).
+        2. Fine pass: score every frame between the neighbours of the best samples (see _peak_windows).
+        Scores go into top_scores. Returns stats.
+        """
+        step = max(1, step)
+        scores = {}
+        signatures = {}
+
+        # 1. Coarse pass
+        stats, keyframes = self._coarse_pass(video_path, cap, step, scores, signatures, frame_cache)
+
+        # 2. Fine pass around the best peaks
+        windows = self._peak_windows(scores, stats['frames_total'], step, peaks)
+        decoded, retrieved = self._score_windows(cap, windows, keyframes, scores, signatures, frame_cache)
+        stats['frames_decoded'] += decoded
+        stats['frames_retrieved'] += retrieved
+
+        for idx, score in scores.items():
+            if score > MIN_SCORE:
+                top_scores.push(idx, score, signatures[idx])
+        # Cuts can only be told from motion inside the densely scored windows
+        for idx in sorted(signatures):
+            scenes.observe(idx, signatures[idx])
+        stats['frames_scored'] = len(scores)
+        return stats
+
+    def _coarse_pass(self, video_path, cap, step, scores, signatures, frame_cache):
+        """
+        Scores a sparse sample of the stream into scores / signatures.
+        Every other frame is predicted from the keyframe before it, so walking past a frame with grab()
+        decodes it just like reading it would: when ffmpeg can list the keyframes, only those are
+        decoded (keyframes less than `step` after the previous sample are not scored). Otherwise the
+        stream is walked with grab() and every `step`-th frame is scored.
+        Returns (stats, keyframe indices).
+        """
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        keyframes = self.keyframe_indices(video_path, fps if 0 < fps <= 1000 else 30)
+        if keyframes:
+            stats = self._score_keyframes(video_path, cap, keyframes, step, scores, signatures, frame_cache)
+            if stats:
+                return stats, keyframes
+            logging.warning(f"Could not decode the keyframes of {video_path}, sampling with grab()")
+
+        frame_count = 0
+        retrieved = 0
+        while cap.grab():
+            if frame_count % step == 0:
+                success, frame = cap.retrieve()
+                if success:
+                    retrieved += 1
+                    self._score_sample(frame_count, frame, scores, signatures, frame_cache)
+            frame_count += 1
+        stats = {'frames_total': frame_count, 'frames_decoded': frame_count, 'frames_retrieved': retrieved}
+        return stats, keyframes
+
+    def _score_keyframes(self, video_path, cap, keyframes, step, scores, signatures, frame_cache):
+        """
+        Coarse pass over the keyframes only: one ffmpeg process decodes them (-skip_frame nokey,
+        as in keyframe_indices) and pipes them as raw BGR frames, in keyframe order.
+        Returns stats, or None if ffmpeg delivered no frame.
+        """
+        width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # passthrough: a constant frame rate output would repeat every keyframe until the next one
+        cmd = [FFMPEG_BIN, '-loglevel', 'error', '-nostdin', '-skip_frame', 'nokey', '-i', video_path,
+               '-map', '0:v:0', '-vsync', 'passthrough', '-vf', f'scale={width}:{height}',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logging.warning(f"Could not start ffmpeg: {e}")
+            return None
+
+        frame_size = width * height * 3
+        decoded = 0
+        last = None
+        try:
+            for frame_idx in keyframes:
+                frame = np.empty((height, width, 3), dtype=np.uint8)
+                if proc.stdout.readinto(memoryview(frame).cast('B')) != frame_size:
                     break
-            
-            if not too_close:
-                final_candidates.append((frame_idx, score))
-        
-        # Return ALL candidates sorted by score (best first)
-        # We don't sort by time here because we want to present the *best* options first, 
-        # or we sort by time for the specific page being viewed.
-        # Actually, user viewing "best" frames might prefer time-ordered for context.
-        # But for pagination, we grab Top N best, then Sort those N by time.
-        return final_candidates
+                decoded += 1
+                if last is not None and frame_idx - last < step:
+                    continue
+                last = frame_idx
+                self._score_sample(frame_idx, frame, scores, signatures, frame_cache)
+        finally:
+            proc.kill()
+            proc.stdout.close()
+            proc.wait()
 
-    def save_frames(self, video_path, candidates, output_dir):
+        if not decoded:
+            return None
+        frame_total = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), keyframes[-1] + 1)
+        # ffmpeg converts every keyframe it decodes
+        return {'frames_total': frame_total, 'frames_decoded': decoded, 'frames_retrieved': decoded}
+
+    def _score_sample(self, frame_idx, frame, scores, signatures, frame_cache):
+        scores[frame_idx] = self.scorer.score(frame)
+        signatures[frame_idx] = self.scorer.signature()
+        frame_cache.offer(frame_idx, scores[frame_idx], frame)
+
+    def _peak_windows(self, scores, frame_total, step, peaks):
+        """
+        Frame ranges to score densely: for each of the best coarse samples, every frame up to its
+        neighbouring samples. Samples are taken best first until the windows of `peaks` samples
+        `step` apart would have been covered, so sparse (keyframe) samples refine fewer, wider windows.
+        Returns merged, ascending [start, end] windows.
+        """
+        samples = sorted(scores)
+        budget = peaks * (2 * step - 1)
+        windows = []
+        for idx in sorted(scores, key=scores.get, reverse=True):
+            if budget <= 0:
+                break
+            pos = bisect_left(samples, idx)
+            start = samples[pos - 1] + 1 if pos else 0
+            end = samples[pos + 1] - 1 if pos + 1 < len(samples) else frame_total - 1
+            windows.append([start, end])
+            budget -= end - start + 1
+
+        merged = []
+        for start, end in sorted(windows):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def _score_windows(self, cap, windows, keyframes, scores, signatures, frame_cache):
+        """
+        Scores every frame of the windows that isn't scored yet.
+        Decoding can only start at a keyframe, so the capture only seeks when a keyframe lies between
+        its position and the next window; otherwise it walks there with grab().
+        Returns (frames decoded, frames retrieved).
+        """
+        decoded = 0
+        retrieved = 0
+        position = None # Unknown until the first seek
+        for start, end in windows:
+            pos = bisect_right(keyframes, start)
+            jump = keyframes[pos - 1] if pos else start
+            if position is None or jump > position:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, jump)
+                position = jump
+            while position <= end:
+                if position < start or position in scores:
+                    # Only decoded to reach the window, or already scored in the coarse pass
+                    if not cap.grab():
+                        return decoded, retrieved
+                else:
+                    success, frame = cap.read()
+                    if not success:
+                        return decoded, retrieved
+                    retrieved += 1
+                    scores[position] = self.scorer.score(frame)
+                    signatures[position] = self.scorer.signature()
+                    frame_cache.offer(position, scores[position], frame)
+                decoded += 1
+                position += 1
+        return decoded, retrieved
+
+    def build_index(self, video_path, candidates, frame_cache=None, thumbnails=INDEX_THUMBNAILS):
+        """
+        Writes the frame index of an analyzed video next to it (see FrameIndex): the ranked
+        candidates, the keyframes and previews of the `thumbnails` best candidates, taken from
+        frame_cache or decoded now (seeking from keyframe to keyframe).
+        Returns the index path, or None if the video can't be opened.
+        """
+        if thumbnails <= 0:
+            return None
+        cap = cv2.VideoCapture(video_path)
+        fps = cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else 0
+        cap.release()
+        if not fps:
+            return None
+
+        keyframes = self.keyframe_indices(video_path, fps)
+        frame_cache = frame_cache or {}
+        top = candidates[:thumbnails]
+        previews = {idx: frame_cache[idx] for idx, _ in top if idx in frame_cache}
+        missing = [(idx, score) for idx, score in top if idx not in previews]
+        if missing:
+            for idx, _, preview in self.render_frames(video_path, missing, keyframes=keyframes):
+                previews[idx] = preview
+        return FrameIndex.write(video_path, fps, candidates, keyframes, previews)
+
+    def render_frames(self, video_path, candidates, frame_cache=None, method=None, keyframes=None):
         """
-        Saves specific frame indices from the video.
+        Encodes specific frames in memory (no temp files).
         candidates: list of (frame_idx, score)
-        
-        Returns: list of (filepath, score) sorted by frame_index (time)
+        frame_cache: optional {frame_idx: jpeg bytes} from analyze_video_result; these are used as previews without decoding.
+        method: "sequential" (one decode pass) or "seek" (seek to every frame). Defaults to FRAME_EXTRACTION.
+        keyframes: optional keyframe indices (from the frame index); sequential decoding then skips ahead to them.
+
+        Returns: list of (frame_idx, score, preview bytes) sorted by frame_index (time)
         """
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            
-        # candidates might be sorted by score. 
-        # We want to save them and name them sequentially or by frame?
-        # User sees "1, 2, 3". 
         # We should sort by time so "1" is start of video and "10" is end.
         candidates_sorted_by_time = sorted(candidates, key=lambda x: x[0])
+        frame_cache = frame_cache or {}
         
-        saved_frames = []
-        
+        # Decode only what isn't cached
+        missing = [frame_idx for frame_idx, _ in candidates_sorted_by_time if frame_idx not in frame_cache]
+        encoded = {}
+        if missing:
+            cap = cv2.VideoCapture(video_path)
+            if cap.isOpened():
+                for frame_idx, frame in self._read_frames(cap, missing, method or FRAME_EXTRACTION, keyframes):
+                    encoded[frame_idx] = self.encode_frame(frame, "jpg", PREVIEW_JPEG_QUALITY)
+            cap.release()
+
+        rendered = []
+        for frame_idx, score in candidates_sorted_by_time:
+            if frame_idx in frame_cache:
+                rendered.append((frame_idx, score, frame_cache[frame_idx]))
+            elif encoded.get(frame_idx):
+                rendered.append((frame_idx, score, encoded[frame_idx]))
+        return rendered
+
+    def render_documents(self, video_path, frame_indices, method=None, keyframes=None):
+        """Decodes frames again and encodes them as full-quality documents. Returns {frame_idx: bytes}."""
+        documents = {}
         cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            return []
-            
-        for i, (frame_idx, score) in enumerate(candidates_sorted_by_time):
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            success, frame = cap.read()
-            if success:
-                # Use frame_idx in filename to ensure uniqueness across pages if needed,
-                # or just use a counter if we are generating a fresh batch.
-                filename = f"frame_{frame_idx}.jpg" 
-                filepath = os.path.join(output_dir, filename)
-                cv2.imwrite(filepath, frame)
-                saved_frames.append((filepath, score))
-                
+        if cap.isOpened():
+            for frame_idx, frame in self._read_frames(cap, sorted(frame_indices), method or FRAME_EXTRACTION, keyframes):
+                data = self.encode_frame(frame)
+                if data:
+                    documents[frame_idx] = data
         cap.release()
+        return documents
+
+    def render_documents_remote(self, media_info, frame_indices, fps):
+        """
+        Full-quality documents of a few frames of a remote video, without downloading it:
+        one ffmpeg process per frame seeks (HTTP range requests) to its timestamp and decodes
+        only from the nearest keyframe. Frame indices are those of the analysis download,
+        which has the same frame rate (fps) as the other renditions.
+        media_info: {'url', 'http_headers'} from InstagramService.get_full_quality_info
+        Returns {frame_idx: bytes}.
+        """
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (media_info.get('http_headers') or {}).items())
+        procs = {}
+        for frame_idx in sorted(frame_indices):
+            cmd = [FFMPEG_BIN, '-loglevel', 'error', '-nostdin']
+            if headers:
+                cmd += ['-headers', headers]
+            # Half a frame early: the first frame at or after this timestamp is frame_idx
+            cmd += ['-ss', f"{max(0.0, (frame_idx - 0.5) / fps):.6f}", '-i', media_info['url'],
+                    '-map', '0:v:0', '-frames:v', '1', '-f', 'image2pipe', '-c:v', 'bmp', 'pipe:1']
+            try:
+                procs[frame_idx] = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                logging.error(f"Could not start ffmpeg: {e}")
+                break
+
+        documents = {}
+        # The seeks run in parallel, results are collected in order
+        for frame_idx, proc in procs.items():
+            output, stderr = proc.communicate()
+            frame = cv2.imdecode(np.frombuffer(output, np.uint8), cv2.IMREAD_COLOR) if output else None
+            if proc.returncode != 0 or frame is None:
+                logging.error(f"Remote frame {frame_idx} failed ({proc.returncode}): {stderr.decode(errors='ignore').strip()}")
+                continue
+            data = self.encode_frame(frame)
+            if data:
+                documents[frame_idx] = data
+        return documents
+
+    def video_info(self, video_path):
+        """{'width', 'height', 'fps'} of a local video, or None if it can't be opened."""
+        cap = cv2.VideoCapture(video_path)
+        try:
+            if not cap.isOpened():
+                return None
+            return {
+                'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                'fps': cap.get(cv2.CAP_PROP_FPS) or None,
+            }
+        finally:
+            cap.release()
+
+    def encode_frame(self, frame, fmt=DOCUMENT_FORMAT, quality=DOCUMENT_JPEG_QUALITY):
+        """Encodes a frame in memory (see encode_frame)."""
+        return encode_frame(frame, fmt, quality)
+
+    def save_frames(self, video_path, candidates, output_dir, frame_cache=None, method=None):
+        """
+        Writes the previews of specific frames to output_dir (render_frames, then one file per frame).
+        Returns: list of (filepath, score) sorted by frame_index (time)
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        saved_frames = []
+        for frame_idx, score, preview in self.render_frames(video_path, candidates, frame_cache, method):
+            filepath = self.frame_path(output_dir, frame_idx)
+            with open(filepath, 'wb') as f:
+                f.write(preview)
+            saved_frames.append((filepath, score))
         return saved_frames
 
+    def frame_path(self, output_dir, frame_idx):
+        """Where save_frames writes a frame. frame_idx in the filename keeps it unique across pages."""
+        return os.path.join(output_dir, f"frame_{frame_idx}.jpg")
+
+    def _read_frames(self, cap, indices, method, keyframes=None):
+        """
+        Yields (frame_idx, frame) for the given ascending frame indices.
+        "sequential" walks the stream once with grab()/retrieve(); on H.264 that is
+        cheaper than a seek per frame, since every seek decodes from the previous keyframe.
+        With known keyframes it jumps to the last keyframe before each target instead of
+        walking the gap, so only the frames from there on are decoded.
+        "seek" is kept for formats where sequential decoding is slower.
+        """
+        if method == "seek":
+            for frame_idx in indices:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+                success, frame = cap.read()
+                if success:
+                    yield frame_idx, frame
+            return
+
+        wanted = iter(indices)
+        target = next(wanted, None)
+        frame_count = 0
+        while target is not None:
+            if keyframes:
+                pos = bisect_right(keyframes, target)
+                if pos and keyframes[pos - 1] > frame_count:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, keyframes[pos - 1])
+                    frame_count = keyframes[pos - 1]
+            if not cap.grab():
+                break
+            if frame_count == target:
+                success, frame = cap.retrieve()
+                if success:
+                    yield target, frame
+                target = next(wanted, None)
+            frame_count += 1
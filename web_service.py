@@ -0,0 +1,63 @@
+import hmac
+import json
+import logging
+from aiohttp import web
+from telegram import Update
+from metrics_service import metrics
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebServer:
+    """
+    The bot's only HTTP server, running on the bot's own event loop.
+    - GET /         -> health check (Render's port check, uptime monitors)
+    - GET /metrics  -> Prometheus metrics
+    - POST <webhook_path> -> Telegram updates (webhook mode only)
+    Webhook updates are only parsed and queued here; the Application processes them
+    with its own concurrency limit, so Telegram gets its 200 right away.
+    """
+    def __init__(self, application=None, webhook_path=None, secret_token=None):
+        self.application = application
+        self.webhook_path = webhook_path
+        self.secret_token = secret_token
+        self._runner = None
+
+        self.app = web.Application()
+        self.app.router.add_get('/', self.health)
+        self.app.router.add_get('/metrics', self.prometheus_metrics)
+        if application and webhook_path:
+            self.app.router.add_post(webhook_path, self.webhook)
+
+    async def health(self, request):
+        return web.Response(text="I am alive")
+
+    async def prometheus_metrics(self, request):
+        return web.Response(body=metrics.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def webhook(self, request):
+        # Telegram sends the secret set with set_webhook in every request (without one, nothing is accepted)
+        if not self.secret_token or not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret_token):
+            metrics.inc('webhook_requests_total', result='forbidden')
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except (ValueError, TypeError, KeyError, json.JSONDecodeError) as e:
+            logging.warning(f"Invalid webhook payload: {e}")
+            metrics.inc('webhook_requests_total', result='invalid')
+            return web.Response(status=400)
+        await self.application.update_queue.put(update)
+        metrics.inc('webhook_requests_total', result='accepted')
+        return web.Response()
+
+    async def start(self, port, host='0.0.0.0'):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Web server listening on {host}:{port}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None